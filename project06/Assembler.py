@@ -0,0 +1,167 @@
+import sys
+import argparse
+import warnings
+from array import array
+from itertools import permutations
+from typing import IO, Iterable, List, Optional
+
+ROM_SIZE = 32768
+
+# the a bit and c1-c6 for every computation the Hack assembly language names
+comp_codes = {
+    "0": 0b0101010,
+    "1": 0b0111111,
+    "-1": 0b0111010,
+    "D": 0b0001100,
+    "A": 0b0110000,
+    "M": 0b1110000,
+    "!D": 0b0001101,
+    "!A": 0b0110001,
+    "!M": 0b1110001,
+    "-D": 0b0001111,
+    "-A": 0b0110011,
+    "-M": 0b1110011,
+    "D+1": 0b0011111,
+    "A+1": 0b0110111,
+    "M+1": 0b1110111,
+    "D-1": 0b0001110,
+    "A-1": 0b0110010,
+    "M-1": 0b1110010,
+    "D+A": 0b0000010,
+    "D+M": 0b1000010,
+    "D-A": 0b0010011,
+    "D-M": 0b1010011,
+    "A-D": 0b0000111,
+    "M-D": 0b1000111,
+    "D&A": 0b0000000,
+    "D&M": 0b1000000,
+    "D|A": 0b0010101,
+    "D|M": 0b1010101,
+}
+# the translator writes M+D as often as D+M, so accept either order for anything that doesn't care about it
+comp_codes.update({f"{comp[2]}{comp[1]}{comp[0]}": code for comp, code in list(comp_codes.items())
+                   if len(comp) == 3 and comp[1] in "+&|" and comp[2] != "1"})
+
+# every order the registers of a dest can be written in
+dest_codes = {"": 0}
+for _length in range(1, 4):
+    for _dest in permutations("ADM", _length):
+        dest_codes["".join(_dest)] = sum({"A": 4, "D": 2, "M": 1}[register] for register in _dest)
+
+jump_codes = {"": 0, "JGT": 1, "JEQ": 2, "JGE": 3, "JLT": 4, "JNE": 5, "JLE": 6, "JMP": 7}
+
+predefined_symbols = {"SP": 0,
+                      "LCL": 1,
+                      "ARG": 2,
+                      "THIS": 3,
+                      "THAT": 4,
+                      "SCREEN": 16384,
+                      "KBD": 24576}
+for _i in range(16):
+    predefined_symbols[f"R{_i}"] = _i
+
+
+class Assembler:
+    def __init__(self):
+        self.symbols = dict(predefined_symbols)
+        self.next_variable = 16
+        # every instruction encoded so far, since the same few dozen C instructions make up nearly all of any program,
+        # and the same few hundred addresses nearly all the rest
+        self.encoded = {}
+        self.addresses = {}
+
+    # first pass: strip comments and whitespace, and note the ROM address of every label
+    def read_instructions(self, lines: Iterable[str]) -> List[str]:
+        instructions = []
+        for line in lines:
+            if "/" in line:
+                line = line.split("//", 1)[0]
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == "(":
+                if line[-1] != ")":
+                    raise ValueError(f"Malformed label {line}")
+                self.symbols[line[1:-1]] = len(instructions)
+            else:
+                instructions.append(line.replace(" ", ""))
+        return instructions
+
+    def encode(self, instruction: str) -> int:
+        dest, _, comp = instruction.rpartition("=")
+        comp, _, jump = comp.partition(";")
+        try:
+            code = 0b1110000000000000 | comp_codes[comp] << 6 | dest_codes[dest] << 3 | jump_codes[jump]
+        except KeyError:
+            raise ValueError(f"Unknown instruction {instruction}") from None
+        self.encoded[instruction] = code
+        return code
+
+    def address(self, symbol: str) -> int:
+        if symbol.isdigit():
+            value = int(symbol)
+        elif symbol in self.symbols:
+            value = self.symbols[symbol]
+        else:
+            value = self.symbols[symbol] = self.next_variable
+            self.next_variable += 1
+        if value >= 0x8000:
+            raise ValueError(f"@{symbol} is {value}, which doesn't fit in an A instruction")
+        return value
+
+    # second pass: turn every instruction into its machine word
+    def assemble(self, lines: Iterable[str]) -> array:
+        instructions = self.read_instructions(lines)
+        words = array("H", bytes(2 * len(instructions)))
+        encoded, addresses = self.encoded, self.addresses
+        for pc, instruction in enumerate(instructions):
+            if instruction[0] == "@":
+                symbol = instruction[1:]
+                address = addresses.get(symbol)
+                if address is None:
+                    address = addresses[symbol] = self.address(symbol)
+                words[pc] = address
+            else:
+                words[pc] = encoded.get(instruction) or self.encode(instruction)
+        if len(words) > ROM_SIZE:
+            warnings.warn(f"{len(words)} instructions won't fit in the {ROM_SIZE} words of ROM")
+        return words
+
+
+def write_hack(words: array, out_stream: IO[str]):
+    out_stream.write("".join(f"{word:016b}\n" for word in words))
+
+
+# a packed ROM image: every word as two bytes, big-endian like the bit strings of a .hack file
+def write_binary(words: array, out_stream: IO[bytes]):
+    words = array("H", words)
+    if sys.byteorder == "little":
+        words.byteswap()
+    out_stream.write(words.tobytes())
+
+
+def assemble_file(filename, outfile, binary=False) -> Optional[str]:
+    try:
+        with open(filename) as in_stream:
+            words = Assembler().assemble(in_stream)
+    except ValueError as e:
+        return f"{filename}: {e}"
+    with open(outfile, "wb" if binary else "w") as out_stream:
+        (write_binary if binary else write_hack)(words, out_stream)
+    return None
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Assembles a .asm file into a .hack file",
+                                         prog="Assembler.py")
+    arg_parser.add_argument("asm", help="the asm file to assemble")
+    arg_parser.add_argument("-o", "--output", help="the file to write (the .asm file's name with .hack or .bin by "
+                                                   "default)")
+    arg_parser.add_argument("--binary", help="write a packed binary ROM image instead of lines of bits",
+                            action="store_true")
+    _args = arg_parser.parse_args()
+    assert (_args.asm[-4:] == ".asm"), "asm must be a .asm file"
+    _outfile = _args.output or _args.asm[:-4] + (".bin" if _args.binary else ".hack")
+    _error = assemble_file(_args.asm, _outfile, _args.binary)
+    if _error:
+        sys.exit(_error)
@@ -0,0 +1,343 @@
+import os.path
+import sys
+import time
+import argparse
+from array import array
+from typing import Iterable, List, Optional
+
+from Assembler import Assembler
+
+RAM_SIZE = 32768
+SCREEN = 16384
+KBD = 24576
+
+# what the ALU computes for each comp field (the a bit then c1-c6), for the computations the Hack assembly language
+# names - with m standing in for RAM[A]
+comp_expressions = {
+    0b0101010: "0",
+    0b0111111: "1",
+    0b0111010: "-1",
+    0b0001100: "d",
+    0b0110000: "a",
+    0b1110000: "m",
+    0b0001101: "~d",
+    0b0110001: "~a",
+    0b1110001: "~m",
+    0b0001111: "-d",
+    0b0110011: "-a",
+    0b1110011: "-m",
+    0b0011111: "d + 1",
+    0b0110111: "a + 1",
+    0b1110111: "m + 1",
+    0b0001110: "d - 1",
+    0b0110010: "a - 1",
+    0b1110010: "m - 1",
+    0b0000010: "d + a",
+    0b1000010: "d + m",
+    0b0010011: "d - a",
+    0b1010011: "d - m",
+    0b0000111: "a - d",
+    0b1000111: "m - d",
+    0b0000000: "d & a",
+    0b1000000: "d & m",
+    0b0010101: "d | a",
+    0b1010101: "d | m",
+}
+
+# the dest bits, in the order they sit in an instruction
+DEST_M, DEST_D, DEST_A = 1, 2, 4
+# and the jump bits, each of which jumps on one sign of the ALU output
+JUMP_POSITIVE, JUMP_ZERO, JUMP_NEGATIVE = 1, 2, 4
+
+
+# the ALU itself, bit by bit, for any comp field that isn't one of the named computations above
+def alu(comp):
+    zx, nx, zy, ny, f, no = ((comp >> bit) & 1 for bit in range(5, -1, -1))
+
+    def compute(a, d, ram):
+        m = ram[a]
+        x = 0 if zx else d
+        y = 0 if zy else (m if comp & 0b1000000 else a)
+        if nx:
+            x = ~x & 0xFFFF
+        if ny:
+            y = ~y & 0xFFFF
+        out = x + y if f else x & y
+        return (~out if no else out) & 0xFFFF
+    return compute
+
+
+def comp_function(comp):
+    if comp not in comp_expressions:
+        return alu(comp)
+    # every value in the machine is kept as an unsigned 16 bit int, so wrap the result back into that range
+    return eval(f"lambda a, d, ram: ({comp_expressions[comp].replace('m', 'ram[a]')}) & 0xFFFF")
+
+
+def read_hack(lines: Iterable[str]) -> List[int]:
+    return [int(line, 2) for line in map(str.strip, lines) if line]
+
+
+class CPU:
+    def __init__(self, rom: Iterable[int]):
+        self.rom = array("H", rom)
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        # every instruction pulled apart once up front, so run never has to look at the bits again
+        self.values = array("H", bytes(2 * len(self.rom)))
+        self.dests = array("B", bytes(len(self.rom)))
+        self.jumps = array("B", bytes(len(self.rom)))
+        self.comps = [None] * len(self.rom)
+        # addresses to stop at whenever a jump lands on them
+        self.breakpoints = set()
+        # the labels and variables of the program, when it was loaded from assembly
+        self.symbols = {}
+        self.halts = set()
+        self.decode()
+
+    def decode(self):
+        functions = {}
+        for pc, instruction in enumerate(self.rom):
+            if not instruction & 0x8000:
+                self.values[pc] = instruction
+                continue
+            comp = (instruction >> 6) & 0b1111111
+            if comp not in functions:
+                functions[comp] = comp_function(comp)
+            self.comps[pc] = functions[comp]
+            self.dests[pc] = (instruction >> 3) & 0b111
+            self.jumps[pc] = instruction & 0b111
+            if self.is_halt(pc):
+                self.halts.add(pc - 1)
+
+    # whether the jump at pc goes straight back to the @ just before it - the (END) @END 0;JMP every program finishes
+    # with, since there's no halt instruction
+    def is_halt(self, pc):
+        return (self.jumps[pc] == 0b111 and pc > 0 and self.comps[pc - 1] is None
+                and self.values[pc - 1] == pc - 1)
+
+    def reset(self):
+        self.a = self.d = self.pc = self.cycles = 0
+        self.halted = False
+
+    # run until the program halts, runs off the end of ROM, jumps to a breakpoint, or limit more instructions have been
+    # executed
+    def run(self, limit: Optional[int] = None) -> int:
+        ram = self.ram
+        rom_size = len(self.rom)
+        # one tuple per address so each step is a single lookup, rather than one into each of the tables
+        ops = list(zip(self.comps, self.values, self.dests, self.jumps))
+        halts = self.halts
+        stops = halts | self.breakpoints
+        a, d, pc = self.a, self.d, self.pc
+        remaining = -1 if limit is None else limit
+        cycles = 0
+        while remaining != cycles and pc < rom_size:
+            cycles += 1
+            comp, value, dest, jump = ops[pc]
+            if comp is None:
+                a = value
+                pc += 1
+                continue
+            out = comp(a, d, ram)
+            target = a
+            if dest:
+                if dest & DEST_M:
+                    ram[a] = out
+                if dest & DEST_D:
+                    d = out
+                if dest & DEST_A:
+                    a = out
+            if jump and jump & (JUMP_NEGATIVE if out & 0x8000 else JUMP_ZERO if out == 0 else JUMP_POSITIVE):
+                pc = target
+                if pc in stops:
+                    self.halted = pc in halts
+                    break
+            else:
+                pc += 1
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        return cycles
+
+    def signed(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+
+# the python a compiled block uses for each named computation, with {a} for A's value - leaving out the mask wherever
+# the result can't leave the 16 bit range anyway
+def block_template(expression):
+    if expression == "-1":
+        return "0xFFFF"
+    expression = expression.replace("a", "{a}").replace("m", "ram[{a}]")
+    return f"({expression}) & 0xFFFF" if any(operator in expression for operator in "+-~") else expression
+
+
+block_templates = {comp: block_template(expression) for comp, expression in comp_expressions.items()}
+
+
+# the test for each jump field, on the signed value of the unsigned out
+jump_conditions = {
+    0b001: "0 < out < 0x8000",
+    0b010: "out == 0",
+    0b011: "out < 0x8000",
+    0b100: "out >= 0x8000",
+    0b101: "out != 0",
+    0b110: "out == 0 or out >= 0x8000",
+}
+
+
+# runs ROM a block at a time, each one compiled on first use into a single python function that takes and returns the
+# registers - rather than going round the interpreter loop once an instruction. A block carries on past branches that
+# aren't taken and through jumps to a fixed address, so most only hand back to run on a return or a loop
+class BlockCPU(CPU):
+    # how many instructions a block compiles before it gives up and falls through to the next one
+    block_size = 256
+
+    def __init__(self, rom: Iterable[int]):
+        super().__init__(rom)
+        # compiled blocks by entry address, as the function and the most instructions it can run
+        self.blocks = {}
+        # the stops the blocks were compiled against, since they never jump to one without handing back to run
+        self.compiled_stops = set()
+
+    def compile_block(self, entry, stops):
+        lines = []
+        namespace = {}
+        # A's value while it's still just the last @, so it can be written into the code as a constant
+        known_a = None
+        pc = entry
+        count = 0
+        visited = set()
+        # a block never falls through onto a stop, since run would take that for a jump to it
+        while pc < len(self.rom) and (count < self.block_size or pc in stops) and pc not in visited:
+            visited.add(pc)
+            count += 1
+            if self.comps[pc] is None:
+                known_a = self.values[pc]
+                pc += 1
+                continue
+            a = "a" if known_a is None else str(known_a)
+            comp = (self.rom[pc] >> 6) & 0b1111111
+            if comp in block_templates:
+                expression = block_templates[comp].format(a=a)
+            else:
+                namespace[f"comp{comp}"] = self.comps[pc]
+                expression = f"comp{comp}({a}, d, ram)"
+            dest, jump = self.dests[pc], self.jumps[pc]
+            pc += 1
+            target = a
+            if jump and dest & DEST_A and known_a is None:
+                lines.append("target = a")
+                target = "target"
+            # assigned left to right, so M is written before A changes
+            targets = [f"ram[{a}]"] * bool(dest & DEST_M) + ["d"] * bool(dest & DEST_D) + ["a"] * bool(dest & DEST_A)
+            if jump and jump != 0b111:
+                targets.append("out")
+            if targets:
+                lines.append(f"{' = '.join(targets)} = {expression}")
+            if dest & DEST_A:
+                known_a = None
+            a = "a" if known_a is None else str(known_a)
+            if jump == 0b111:
+                if target == "target" or target == "a" or int(target) in stops or int(target) in visited:
+                    lines.append(f"return {target}, {a}, d, {count}")
+                    break
+                # a jump to a fixed address is just somewhere else to carry on compiling from
+                pc = int(target)
+            elif jump:
+                lines.append(f"if {jump_conditions[jump]}:")
+                lines.append(f"    return {target}, {a}, d, {count}")
+        else:
+            if known_a is not None:
+                lines.append(f"a = {known_a}")
+            lines.append(f"return {pc}, a, d, {count}")
+        source = "def block(ram, a, d):\n" + "".join(f"    {line}\n" for line in lines)
+        exec(compile(source, f"<block {entry}>", "exec"), namespace)
+        return namespace["block"], count
+
+    def run(self, limit: Optional[int] = None) -> int:
+        ram, blocks = self.ram, self.blocks
+        rom_size = len(self.rom)
+        halts = self.halts
+        stops = halts | self.breakpoints
+        if stops != self.compiled_stops:
+            blocks.clear()
+            self.compiled_stops = stops
+        budget = float("inf") if limit is None else limit
+        a, d, pc = self.a, self.d, self.pc
+        cycles = 0
+        stopped = False
+        while pc < rom_size:
+            block = blocks.get(pc)
+            if block is None:
+                block = blocks[pc] = self.compile_block(pc, stops)
+            function, most = block
+            if cycles + most > budget:
+                break
+            pc, a, d, count = function(ram, a, d)
+            cycles += count
+            if pc in stops:
+                self.halted = pc in halts
+                stopped = True
+                break
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        # the last few instructions of a limited run won't make a whole block, so interpret those one at a time
+        if not stopped and pc < rom_size:
+            cycles += super().run(limit - cycles)
+        return cycles
+
+
+engines = {"interpreter": CPU, "blocks": BlockCPU}
+
+
+# loads a .hack file, or assembles a .asm one
+def load(filename, engine=BlockCPU) -> CPU:
+    with open(filename) as in_stream:
+        if not filename.endswith(".asm"):
+            return engine(read_hack(in_stream))
+        assembler = Assembler()
+        cpu = engine(assembler.assemble(in_stream))
+    cpu.symbols = assembler.symbols
+    return cpu
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Runs a .hack program on an emulated Hack computer",
+                                         prog="CPUEmulator.py")
+    arg_parser.add_argument("hack", help="the .hack or .asm file to run")
+    arg_parser.add_argument("-c", "--cycles", help="stop after this many instructions, if the program hasn't halted",
+                            type=int)
+    arg_parser.add_argument("-b", "--break", help="stop when a jump lands on this ROM address, or label of a .asm file",
+                            default=[], action="append", dest="breakpoints")
+    arg_parser.add_argument("-e", "--engine", help="run one instruction at a time, or compile basic blocks to python "
+                                                   "functions as they're reached", choices=sorted(engines),
+                            default="blocks")
+    arg_parser.add_argument("--dump", help="print RAM[start] to RAM[end - 1] once finished, as start:end",
+                            default="0:16")
+    _args = arg_parser.parse_args()
+    if not os.path.isfile(_args.hack):
+        sys.exit(f"{_args.hack} not found")
+    try:
+        _cpu = load(_args.hack, engines[_args.engine])
+    except ValueError as e:
+        sys.exit(f"{_args.hack}: {e}")
+    for _breakpoint in _args.breakpoints:
+        if not _breakpoint.isdigit() and _breakpoint not in _cpu.symbols:
+            sys.exit(f"no label {_breakpoint} to break at")
+        _cpu.breakpoints.add(int(_breakpoint) if _breakpoint.isdigit() else _cpu.symbols[_breakpoint])
+    _start = time.perf_counter()
+    _cpu.run(_args.cycles)
+    _elapsed = time.perf_counter() - _start
+    _status = "halted" if _cpu.halted else "ran off the end of ROM" if _cpu.pc >= len(_cpu.rom) \
+        else "hit a breakpoint" if _cpu.pc in _cpu.breakpoints else "stopped"
+    print(f"{len(_cpu.rom)} words of ROM, {_cpu.cycles} cycles, {_status} at {_cpu.pc}")
+    print(f"{_elapsed:.3f}s, {_cpu.cycles / _elapsed / 1e6 if _elapsed else 0:.2f} MIPS")
+    _first, _last = map(int, _args.dump.split(":"))
+    for _address in range(_first, _last):
+        print(f"RAM[{_address}] = {_cpu.signed(_address)}")
@@ -1,13 +1,18 @@
 import glob
+import io
 import os.path
+import re
 import argparse
 import warnings
-from enum import Enum, auto
+from enum import IntEnum, auto
 import sys
-from typing import Optional
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import Dict, Iterable, Iterator, List, Optional
 
 
-class CommandType(Enum):
+class CommandType(IntEnum):
     C_NONE = auto()
     C_ARITHMETIC = auto()
     C_PUSH = auto()
@@ -21,7 +26,7 @@ class CommandType(Enum):
 
 
 class Command:
-    line_count = 0
+    __slots__ = ("type", "arg1", "arg2")
 
     arithmetics = ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]
     non_arithmetics = {
@@ -34,14 +39,17 @@ class Command:
         "return": CommandType.C_RETURN,
         "call": CommandType.C_CALL
     }
+    # the type of command each first word makes, arithmetic or not
+    types = dict(non_arithmetics, **{arithmetic: CommandType.C_ARITHMETIC for arithmetic in arithmetics})
+    words = {command_type: word for word, command_type in non_arithmetics.items()}
 
-    def parse(self):
-        command = self.text.split(" ")
-        if command[0] in Command.arithmetics:
-            self.type = CommandType.C_ARITHMETIC
+    def parse(self, text):
+        # segment, function and label names repeat a lot, so share the one copy of each
+        command = [sys.intern(word) for word in text.split(" ")]
+        self.type = Command.types[command[0]]
+        if self.type == CommandType.C_ARITHMETIC:
             self.arg1 = command[0]
             return
-        self.type = Command.non_arithmetics[command[0]]
         try:
             self.arg1 = command[1]
         except IndexError:
@@ -54,21 +62,37 @@ class Command:
             self.arg2 = command[2]
 
     def __init__(self, text):
-        self.line_idx = Command.line_count
         self.type = CommandType.C_NONE
-        self.text = text.strip().split("//")[0]
-        if len(self.text) == 0:
+        text = text.strip().split("//")[0]
+        if len(text) == 0:
             return
         self.arg1 = ""
         self.arg2 = -1
-        self.parse()
+        self.parse(text)
+
+    # build a command straight from its parts, as a compiler hands them out, with no text to parse
+    @classmethod
+    def from_parts(cls, command, arg1=None, arg2=None):
+        self = cls.__new__(cls)
+        self.type = Command.types[command]
+        self.arg1 = command if self.type == CommandType.C_ARITHMETIC else sys.intern(arg1 or "")
+        self.arg2 = -1 if arg2 is None else arg2
+        return self
+
+    def __str__(self):
+        if self.type == CommandType.C_NONE or self.type == CommandType.C_ARITHMETIC:
+            return getattr(self, "arg1", "")
+        command = Command.words[self.type]
+        if self.arg2 != -1:
+            return f"{command} {self.arg1} {self.arg2}"
+        return f"{command} {self.arg1}" if self.arg1 else command
 
 
 class Parser:
-    def __init__(self, input_stream):
-        self.data = input_stream.readlines()
+    def __init__(self, input_stream, streaming=False):
+        self.in_stream = input_stream
         self.currentCommand: Optional[Command] = None
-        self.commands = []
+        self.commands = deque()
         self.symbol_table = {"SP": 0,
                              "LCL": 1,
                              "ARG": 2,
@@ -78,18 +102,38 @@ class Parser:
                              "KBD": 24576}
         for i in range(16):
             self.symbol_table[f'R{i}'] = i
-        self.read_commands()
+        # in streaming mode commands are only read from the stream as they're asked for
+        self.pending = self.stream_commands()
+        if not streaming:
+            self.read_commands()
+
+    def __iter__(self) -> Iterator[Command]:
+        # hand out anything already read, then keep reading lazily from the stream
+        while self.commands:
+            self.advance()
+            yield self.currentCommand
+        for command in self.pending:
+            self.currentCommand = command
+            yield command
 
     def has_more_commands(self):
-        return len(self.commands) > 0
+        # when streaming, read one command ahead so there's something to say yes about
+        if not self.commands:
+            command = next(self.pending, None)
+            if command is None:
+                return False
+            self.commands.append(command)
+        return True
+
+    def stream_commands(self) -> Iterator[Command]:
+        # read the input one line at a time, so we never hold more than a single line of it
+        for line in self.in_stream:
+            command = Command(line)
+            if command.type != CommandType.C_NONE:
+                yield command
 
     def read_commands(self):
-        while len(self.data) > 0:
-            command = Command(self.data.pop(0))
-            if command.type == CommandType.C_NONE:
-                continue
-            else:
-                self.commands.append(command)
+        self.commands.extend(self.pending)
         # # loop through the symbols and build symbol table
         # symbol_idx = 16
         # for command in self.commands:
@@ -99,7 +143,7 @@ class Parser:
         #             symbol_idx += 1
 
     def advance(self):
-        self.currentCommand = self.commands.pop(0)
+        self.currentCommand = self.commands.popleft()
 
     def command_type(self):
         return self.currentCommand.type
@@ -111,11 +155,266 @@ class Parser:
         return self.currentCommand.arg2
 
 
+# a whole program's commands, by the name of the file they came from, for the passes that need to see all of them
+def read_program(filenames) -> Dict[str, List[Command]]:
+    program = {}
+    for filename in filenames:
+        with open(filename) as in_stream:
+            program[os.path.basename(filename)[:-3]] = list(Parser(in_stream, streaming=True))
+    return program
+
+
+# split one file's commands up into its functions, each starting with its function command
+def split_functions(commands: List[Command]) -> List[List[Command]]:
+    functions = []
+    for command in commands:
+        if command.type == CommandType.C_FUNCTION or not functions:
+            functions.append([])
+        functions[-1].append(command)
+    return functions
+
+
+class Inliner:
+    temp_size = 8
+
+    def __init__(self, max_size):
+        # the most commands a function's body can have and still be inlined
+        self.max_size = max_size
+        self.inlined = Counter()
+        self.site_count = 0
+        # inlined arguments and locals live in whichever temp slots nothing in the program touches
+        self.free_temps: List[int] = []
+
+    def inlinable(self, function: List[Command]) -> bool:
+        body = function[1:]
+        if len(body) > self.max_size:
+            return False
+        for command in body:
+            # anything that calls out isn't a leaf, and can't be inlined without its calls clobbering temp. setting
+            # this would leak out to the caller, whose pointer a real return would have restored - that is fine, since
+            # the compiler always sets pointer 1 right before it uses that, and never across a call
+            if command.type == CommandType.C_CALL or command.type == CommandType.C_POP and command.arg1 == "pointer" \
+                    and command.arg2 == 0:
+                return False
+        return True
+
+    # whether a call from the given file can have the callee's body in its place
+    def fits(self, callee, caller_file, num_args) -> bool:
+        callee_file, function = callee
+        if num_args + function[0].arg2 > len(self.free_temps):
+            return False
+        # every argument and local the body uses needs a slot of its own
+        for command in function:
+            if command.type in (CommandType.C_PUSH, CommandType.C_POP) and \
+                    (command.arg1 == "argument" and command.arg2 >= num_args or
+                     command.arg1 == "local" and command.arg2 >= function[0].arg2):
+                return False
+        # statics belong to the file they're declared in, so a function using them has to stay in it
+        return callee_file == caller_file or not any(
+            command.arg1 == "static" for command in function if command.type in (CommandType.C_PUSH, CommandType.C_POP))
+
+    # the callee's body, with its arguments and locals moved into temp, its labels made unique to this call site
+    # and its returns turned into jumps to the end of it
+    def expand(self, function: List[Command], num_args) -> List[Command]:
+        name, num_locals = function[0].arg1, function[0].arg2
+        self.site_count += 1
+        suffix = f"${name}${self.site_count}"
+        end = f"END{suffix}"
+        arguments, locals_ = self.free_temps[:num_args], self.free_temps[num_args:num_args + num_locals]
+        commands = [Command.from_parts("pop", "temp", slot) for slot in reversed(arguments)]
+        for slot in locals_:
+            commands.append(Command.from_parts("push", "constant", 0))
+            commands.append(Command.from_parts("pop", "temp", slot))
+        body = function[1:]
+        for position, command in enumerate(body):
+            if command.type == CommandType.C_PUSH or command.type == CommandType.C_POP:
+                if command.arg1 == "argument":
+                    command = Command.from_parts(Command.words[command.type], "temp", arguments[command.arg2])
+                elif command.arg1 == "local":
+                    command = Command.from_parts(Command.words[command.type], "temp", locals_[command.arg2])
+            elif command.type in (CommandType.C_LABEL, CommandType.C_GOTO, CommandType.C_IF):
+                command = Command.from_parts(Command.words[command.type], command.arg1 + suffix)
+            elif command.type == CommandType.C_RETURN:
+                # the return value is already on top of the stack, right where the call would have left it
+                if position == len(body) - 1:
+                    continue
+                command = Command.from_parts("goto", end)
+            commands.append(command)
+        if any(command.type == CommandType.C_RETURN for command in body[:-1]):
+            commands.append(Command.from_parts("label", end))
+        return commands
+
+    # inline every call to a small enough leaf function, wherever in the program it's made
+    def inline(self, program: Dict[str, List[Command]]) -> Dict[str, List[Command]]:
+        functions = {}
+        for name, commands in program.items():
+            for function in split_functions(commands):
+                if function[0].type == CommandType.C_FUNCTION:
+                    functions[function[0].arg1] = (name, function)
+        candidates = {function_name: (name, function) for function_name, (name, function) in functions.items()
+                      if self.inlinable(function)}
+        used_temps = {command.arg2 for commands in program.values() for command in commands
+                      if command.type in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 == "temp"}
+        self.free_temps = [slot for slot in range(Inliner.temp_size) if slot not in used_temps]
+        inlined_program = {}
+        for name, commands in program.items():
+            inlined_program[name] = inlined = []
+            for command in commands:
+                callee = command.type == CommandType.C_CALL and candidates.get(command.arg1)
+                if callee and self.fits(callee, name, command.arg2):
+                    inlined.extend(self.expand(callee[1], command.arg2))
+                    self.inlined[command.arg1] += 1
+                else:
+                    inlined.append(command)
+        return inlined_program
+
+    def report(self):
+        print(f"Inlined {sum(self.inlined.values())} call sites of {len(self.inlined)} functions")
+        for function, count in self.inlined.most_common():
+            print(f"  {function:<30} {count:>5}")
+
+
+class TreeShaker:
+    def __init__(self, entry="Sys.init"):
+        self.entry = entry
+        self.function_count = 0
+        # the functions nothing reachable calls, by the file they came out of
+        self.dropped: Dict[str, List[Command]] = {}
+
+    # drop every function that can't be reached by following calls from the entry point
+    def shake(self, program: Dict[str, List[Command]]) -> Dict[str, List[Command]]:
+        functions = {}
+        for name, commands in program.items():
+            for function in split_functions(commands):
+                functions[function[0].arg1 if function[0].type == CommandType.C_FUNCTION else None] = function
+        self.function_count = len(functions)
+        if self.entry not in functions:
+            print(f"No {self.entry} to start from, so nothing was dropped")
+            return program
+        reachable = {self.entry}
+        to_visit = [self.entry]
+        while to_visit:
+            for command in functions.get(to_visit.pop(), ()):
+                if command.type == CommandType.C_CALL and command.arg1 not in reachable:
+                    reachable.add(command.arg1)
+                    to_visit.append(command.arg1)
+        shaken_program = {}
+        for name, commands in program.items():
+            shaken_program[name] = []
+            for function in split_functions(commands):
+                # anything before the first function isn't part of one, so can't be dropped
+                if function[0].type != CommandType.C_FUNCTION or function[0].arg1 in reachable:
+                    shaken_program[name].extend(function)
+                else:
+                    self.dropped.setdefault(name, []).extend(function)
+        return shaken_program
+
+    def report(self, options):
+        # translate what was dropped on its own, to see how much ROM it would have taken up
+        scratch = CodeWriter(None, **options, in_memory=True)
+        for name, commands in self.dropped.items():
+            scratch.translate_commands(name, commands)
+        words = scratch.line_count
+        dropped_count = sum(command.type == CommandType.C_FUNCTION for commands in self.dropped.values()
+                            for command in commands)
+        print(f"Dropped {dropped_count} of {self.function_count} functions as unreachable from {self.entry}, "
+              f"saving {words} words ({2 * words} bytes) of ROM")
+
+
+def asm_pattern(*lines, followed_by=""):
+    # join a sequence of instruction patterns into a regex that only matches whole lines of the joined IR
+    return re.compile("(?<![^\n])" + "".join(line + "\n" for line in lines) + followed_by)
+
+
+class Peephole:
+    push_d = (r"@SP", r"AM=M\+1", r"A=A-1", r"M=D")
+    pop_d = (r"@SP", r"AM=M-1", r"D=M")
+    indirect_address = (r"(@(?:LCL|ARG|THIS|THAT))", r"D=M", r"(@\d+)", r"A=D\+A", r"D=A", r"@R15", r"M=D")
+    # write_arithmetic's R13/R14 operations, re-expressed in place with the top of the stack in M and y in D
+    in_place_ops = {"M+D": "D+M", "D-M": "M-D", "D&M": "D&M", "D|M": "D|M"}
+
+    # each rule is a pattern and its replacement, tried in order on every pass
+    # the R13/R14 sequences are matched first, before the generic rules below break them up
+    rules = [
+        # binary op: y (in D) was stored in R14 and x popped into R13, so do it straight on the stack top instead
+        (asm_pattern(r"@R14", r"M=D", *pop_d, r"@R13", r"M=D", r"@R13", r"D=M", r"@R14", r"M=(M\+D|D-M|D&M|D\|M)",
+                     r"@R14", r"D=M", *push_d),
+         lambda match: f"@SP\nA=M-1\nM={Peephole.in_place_ops[match[1]]}\n"),
+        # unary op: the operand is already in D, so push the result straight from it
+        (asm_pattern(r"@R14", r"M=D", r"@R14", r"M=([-!])M", r"@R14", r"D=M", *push_d),
+         lambda match: f"@SP\nAM=M+1\nA=A-1\nM={match[1]}D\n"),
+        # comparison: compare against the stack top in place, and only set it to false if the jump isn't taken
+        (asm_pattern(r"@R14", r"M=D", *pop_d, r"@R13", r"M=D", r"@R13", r"D=M", r"@R14", r"D=D-M",
+                     r"(@[^\n]+)", r"(D;J\w\w)", r"@R14", r"M=0", r"@([^\n]+)", r"0;JMP", r"\(([^\n]+)\)",
+                     r"@R14", r"M=-1", r"\(\3\)", r"@R14", r"D=M", *push_d),
+         "@SP\nA=M-1\nD=M-D\nM=-1\n\\1\n\\2\n@SP\nA=M-1\nM=0\n(\\4)\n"),
+        # push then an immediate pop of the same value: D already holds it, so skip the stack entirely
+        (asm_pattern(*push_d, *pop_d, followed_by="(?=@)"), ""),
+        # push then an indirect pop: the value doesn't need to move SP while its destination is worked out
+        (asm_pattern(*push_d, *indirect_address, *pop_d),
+         "@SP\nA=M\nM=D\n\\1\nD=M\n\\2\nA=D+A\nD=A\n@R15\nM=D\n@SP\nA=M\nD=M\n"),
+        # pop, then straight away address the new stack top
+        (asm_pattern(*pop_d, r"@SP", r"A=M-1"), "@SP\nAM=M-1\nD=M\nA=A-1\n"),
+        # pop, then straight away push again
+        (asm_pattern(*pop_d, *push_d[:3]), "@SP\nA=M-1\nD=M\n"),
+        # re-addressing a register whose address is still in A
+        (asm_pattern(r"(@[^\n]+)", r"(M=[^\n]+)", r"\1"), "\\1\n\\2\n"),
+        # reading back the value that was just stored
+        (asm_pattern(r"M=([^\n]+)", r"D=M"), "MD=\\1\n"),
+    ]
+
+    def __init__(self):
+        self.rom_before = 0
+        self.rom_after = 0
+
+    @staticmethod
+    def rom_size(instructions):
+        return sum(1 for instruction in instructions if instruction[:1] not in "(/")
+
+    def optimize(self, instructions):
+        self.rom_before += Peephole.rom_size(instructions)
+        # comments are dropped, they'd only get in the way of matching
+        instructions = [instruction for instruction in instructions if instruction[:1] != "/"]
+        text = "".join(instruction + "\n" for instruction in instructions)
+        changed = True
+        while changed:
+            changed = False
+            for pattern, replacement in Peephole.rules:
+                text, count = pattern.subn(replacement, text)
+                changed = changed or count > 0
+        instructions = text.splitlines()
+        self.rom_after += Peephole.rom_size(instructions)
+        return instructions
+
+
+# the instructions that step A along from a segment's base register to one of its slots
+def address_steps(register, index):
+    return (f"@{register}", "A=M+1" if index else "A=M") + ("A=A+1",) * (index - 1)
+
+
 class CodeWriter:
     indirect_segments = ["THIS", "THAT", "LOCAL", "ARGUMENT"]
+    comparison_jumps = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+    # binary operations done straight into D, with x in M and y in D
+    binary_ops = {"add": "D+M", "sub": "M-D", "and": "D&M", "or": "D|M"}
+    base_registers = {"LOCAL": "LCL", "ARGUMENT": "ARG", "THIS": "THIS", "THAT": "THAT"}
+    # the general way of addressing an indirect segment's slot, which goes through D
+    indirect_address_size = 4
+    # functions with more locals than this zero them in a shared loop, rather than one store after another
+    max_unrolled_locals = 8
+    # indirect slots this close to the base are addressed by stepping A along from it instead, which leaves D alone
+    max_address_steps = 6
+    address_templates = {(segment, index): address_steps(register, index) for (segment, register), index
+                         in product(base_registers.items(), range(max_address_steps + 1))}
+    negated_jumps = {"JEQ": "JNE", "JGT": "JLE", "JLT": "JGE"}
 
-    def __init__(self, output, overwrite=False):
-        self.out_stream = sys.stdout
+    def __init__(self, output, overwrite=False, line_numbers=False, buffer_size=8192, optimize=False,
+                 shared_calls=False, shared_compare=False, cache_top=False, in_memory=False):
+        # kept so worker processes can set up a CodeWriter that generates the same code as this one
+        self.options = dict(optimize=optimize, shared_calls=shared_calls, shared_compare=shared_compare,
+                            cache_top=cache_top)
+        # an in-memory writer has no stream at all, its lines only being kept in lines or counted
+        self.out_stream = None if in_memory else sys.stdout
         self.do_close = False
         if output is not None:
             assert overwrite or not os.path.exists(output), "output file already exists and overwrite flag not given!"
@@ -126,17 +425,65 @@ class CodeWriter:
         self.current_function = None
         self.return_idx = 0
         self.line_count = 0
+        # annotating every instruction with its ROM address is handy for debugging, but bloats release builds
+        self.line_numbers = line_numbers
+        # lines are collected here and written out in blocks of buffer_size, rather than one write per line
+        self.buffer = []
+        self.buffer_size = buffer_size
+        # set to a list to also keep every line written, so it can be assembled without reading the file back
+        self.lines: Optional[list] = None
+        # when optimising, instructions are held back here until they've been through the peephole optimiser
+        self.peephole = Peephole() if optimize else None
+        self.instructions = []
+        # calls and returns can jump to one shared copy of the frame handling instead of inlining it every time
+        self.shared_calls = shared_calls
+        self.uses_shared_call = False
+        self.uses_shared_return = False
+        self.call_count = 0
+        self.return_count = 0
+        # comparisons can likewise jump to one shared routine per kind, or fuse with an if-goto that follows them
+        self.shared_compare = shared_compare
+        self.used_comparisons = set()
+        self.held_commands = []
+        self.uses_shared_zero = False
+        # the top of the stack can be kept in D rather than RAM from one command to the next, and only stored when
+        # something needs the whole stack in RAM
+        self.cache_top = cache_top
+        self.top_in_d = False
+
+    def flush_instructions(self):
+        if self.peephole is not None:
+            for text in self.peephole.optimize(self.instructions):
+                self.emit(text)
+            self.instructions.clear()
+
+    def flush(self):
+        if self.buffer:
+            if self.lines is not None:
+                self.lines.extend(self.buffer)
+            # with no out_stream the lines are only wanted in memory
+            if self.out_stream is not None:
+                self.buffer.append("")
+                self.out_stream.write("\n".join(self.buffer))
+            self.buffer.clear()
 
     def close(self):
+        self.flush_instructions()
+        self.flush()
         if self.do_close:
             self.out_stream.close()
 
     def get_bool_label(self):
+        # numbered per file, so files can be translated independently of each other
         self.label_count += 1
-        return f".bool_label{self.label_count}"
+        return f".{self.current_file}.bool_label{self.label_count}"
 
     # TODO: implement the label / symbol getting for pushpop, and allow for hard-coded ram locations
     def write_arithmetic(self, command: str):
+        if self.cache_top:
+            return self.write_cached_arithmetic(command)
+        if self.shared_compare and command in CodeWriter.comparison_jumps:
+            return self.write_shared_compare(command)
         self.write(f"//{command}")
         # pop first argument
         self.write_pushpop("pop", "RAM", 14)
@@ -180,8 +527,14 @@ class CodeWriter:
             self.write(f"({label_done})")
         self.write_pushpop("push", "RAM", 14)
 
-    def write_address(self, segment, index):
+    # address a segment's slot in A, keep_d saying whether D has to survive it
+    def write_address(self, segment, index, keep_d=False):
         segment = segment.upper()
+        template = CodeWriter.address_templates.get((segment, index))
+        if template is not None and (keep_d or len(template) <= CodeWriter.indirect_address_size):
+            for instruction in template:
+                self.write(instruction)
+            return
         if segment == "CONSTANT":
             raise ValueError("CONSTANT is not a real address")
         elif segment == "RAM":
@@ -214,6 +567,95 @@ class CodeWriter:
         self.write("AM=M-1")
         self.write("D=M")
 
+    # pop the top of the stack into D, unless it's already there
+    def write_top_into_d(self):
+        if self.top_in_d:
+            self.top_in_d = False
+        else:
+            self.write_pop_into_d()
+
+    # store the top of the stack to RAM if it's being kept in D
+    def spill(self):
+        if self.top_in_d:
+            self.top_in_d = False
+            self.write_pushpop(push_straight_from_d=True)
+
+    def write_cached_push(self, segment, index):
+        self.spill()
+        self.write(f"//push, {segment}[{index}]")
+        segment = segment.upper()
+        if segment == "CONSTANT":
+            if index in (0, 1):
+                self.write(f"D={index}")
+            else:
+                self.write(f"@{index}")
+                self.write("D=A")
+        else:
+            self.write_address(segment, index)
+            self.write("D=M")
+        self.top_in_d = True
+
+    def write_cached_pop(self, segment, index):
+        self.write(f"//pop, {segment}[{index}]")
+        self.write_top_into_d()
+        segment = segment.upper()
+        if segment not in CodeWriter.indirect_segments or (segment, index) in CodeWriter.address_templates:
+            self.write_address(segment, index, keep_d=True)
+        else:
+            self.write("@R13")
+            self.write("M=D")
+            self.write_address(segment, index)
+            self.write("D=A")
+            self.write("@R14")
+            self.write("M=D")
+            self.write("@R13")
+            self.write("D=M")
+            self.write("@R14")
+            self.write("A=M")
+        self.write("M=D")
+
+    def write_cached_arithmetic(self, command):
+        if self.shared_compare and command in CodeWriter.comparison_jumps:
+            self.spill()
+            return self.write_shared_compare(command)
+        self.write(f"//{command}")
+        self.write_top_into_d()
+        if command == "neg":
+            self.write("D=-D")
+        elif command == "not":
+            self.write("D=!D")
+        else:
+            self.write("@SP")
+            self.write("AM=M-1")
+            if command in CodeWriter.binary_ops:
+                self.write(f"D={CodeWriter.binary_ops[command]}")
+            else:
+                label_base = self.get_bool_label()
+                self.write("D=M-D")
+                self.write(f"@{label_base}_is_true")
+                self.write(f"D;{CodeWriter.comparison_jumps[command]}")
+                self.write("D=0")
+                self.write(f"@{label_base}_all_done")
+                self.write("0;JMP")
+                self.write(f"({label_base}_is_true)")
+                self.write("D=-1")
+                self.write(f"({label_base}_all_done)")
+        self.top_in_d = True
+
+    # returns whether the command could be written without the whole stack being in RAM
+    def write_cached(self, command: Command):
+        if command.type == CommandType.C_ARITHMETIC:
+            self.write_cached_arithmetic(command.arg1)
+        elif command.type == CommandType.C_PUSH:
+            self.write_cached_push(command.arg1, command.arg2)
+        elif command.type == CommandType.C_POP:
+            self.write_cached_pop(command.arg1, command.arg2)
+        elif command.type == CommandType.C_IF:
+            self.write_if(command.arg1)
+        else:
+            return False
+        return True
+
     def write_pushpop(self, push_or_pop="push", segment="", index=0, push_straight_from_d=False):
         if push_straight_from_d:
             self.write("// push D")
@@ -231,10 +673,11 @@ class CodeWriter:
             self.write("A=A-1")
             self.write("M=D")
         else:
-            if segment.upper() not in CodeWriter.indirect_segments:
+            if segment.upper() not in CodeWriter.indirect_segments \
+                    or (segment.upper(), index) in CodeWriter.address_templates:
                 # the simple case won't overwrite the D-register, so we can safely call write_address()
                 self.write_pop_into_d()
-                self.write_address(segment, index)
+                self.write_address(segment, index, keep_d=True)
                 self.write("M=D")
             else:
                 # calling write_address will overwrite the D register so we need to be careful and roundabout
@@ -253,9 +696,67 @@ class CodeWriter:
                 # and finally deposit the data from the stack into it
                 self.write("M=D")
 
+    def write_shared_compare(self, command):
+        self.write(f"//{command}")
+        self.used_comparisons.add(command)
+        return_label = self.get_bool_label()
+        # the routine takes the return address in D
+        self.write(f"@{return_label}")
+        self.write("D=A")
+        self.write(f"@${command.upper()}")
+        self.write("0;JMP")
+        self.write(f"({return_label})")
+
+    def write_compare_branch(self, jump, label):
+        self.write(f"// {jump} if-goto {label}")
+        # pop y, then pop x and jump on x - y, without ever pushing the comparison's result
+        self.write_top_into_d()
+        self.write("@SP")
+        self.write("AM=M-1")
+        self.write("D=M-D")
+        self.write(self.get_label(label))
+        self.write(f"D;{jump}")
+
+    # returns whether the command has been held back (or used up) as part of a comparison
+    def hold_comparison(self, command: Command):
+        held = self.held_commands
+        is_arithmetic = command.type == CommandType.C_ARITHMETIC
+        if not held:
+            if is_arithmetic and command.arg1 in CodeWriter.comparison_jumps:
+                held.append(command)
+                return True
+            return False
+        # a not straight after the comparison can be folded into the jump
+        if is_arithmetic and command.arg1 == "not" and len(held) == 1:
+            held.append(command)
+            return True
+        if command.type == CommandType.C_IF:
+            jump = CodeWriter.comparison_jumps[held[0].arg1]
+            if len(held) == 2:
+                jump = CodeWriter.negated_jumps[jump]
+            held.clear()
+            self.write_compare_branch(jump, command.arg1)
+            return True
+        # anything else needs the comparison's result on the stack after all
+        self.release_comparison()
+        return self.hold_comparison(command)
+
+    def release_comparison(self):
+        held = self.held_commands[:]
+        self.held_commands.clear()
+        for command in held:
+            self.write_arithmetic(command.arg1)
+
     def write_command(self, command: Command):
         if command.type == CommandType.C_NONE:
             return
+        if self.shared_compare and self.hold_comparison(command):
+            return
+        if self.cache_top:
+            if self.write_cached(command):
+                return
+            # labels, jumps, calls and returns all need the whole stack in RAM
+            self.spill()
         if command.type == CommandType.C_LABEL:
             self.write_label(command.arg1)
         if command.type == CommandType.C_ARITHMETIC:
@@ -280,12 +781,21 @@ class CodeWriter:
 
     def write_if(self, label):
         self.write(f"// if-goto {label}")
-        self.write_pop_into_d()
+        self.write_top_into_d()
         self.write(self.get_label(label))
         self.write("D;JNE")
 
     def write_return(self):
         self.write("// return")
+        self.return_count += 1
+        if self.shared_calls:
+            self.uses_shared_return = True
+            self.write("@$RETURN")
+            self.write("0;JMP")
+        else:
+            self.write_frame_teardown()
+
+    def write_frame_teardown(self):
         # store the current LCL in R13 (and D for now)
         self.write("@R1")
         self.write("D=M")
@@ -329,12 +839,48 @@ class CodeWriter:
         if not name.split(".")[:-2] == self.current_file.split(".")[:-2]:
             raise NameError(f"function {name} declared in {self.current_file} illegally")
         self.return_idx = 0
+        # nothing can be optimised across a function boundary, so this is a good time to pass on what we have
+        self.flush_instructions()
         self.write(f"// function {name} {num_locals}")
         # create entrypoint
         self.write(f"({self.current_function})")
-        # initialise locals
-        for i in range(num_locals):
-            self.write_pushpop("push", "CONSTANT", 0)
+        self.write_locals(num_locals)
+
+    # push num_locals zeros, in whichever way is cheapest for that many
+    def write_locals(self, num_locals):
+        if num_locals == 0:
+            return
+        self.write(f"// initialise {num_locals} locals")
+        if num_locals <= 2:
+            for _ in range(num_locals):
+                self.write("@SP")
+                self.write("AM=M+1")
+                self.write("A=A-1")
+                self.write("M=0")
+        elif num_locals <= CodeWriter.max_unrolled_locals:
+            # zero each slot in turn, then move SP past them all at once
+            self.write("@SP")
+            self.write("A=M")
+            for i in range(num_locals):
+                if i:
+                    self.write("A=A+1")
+                self.write("M=0")
+            self.write("D=A+1")
+            self.write("@SP")
+            self.write("M=D")
+        else:
+            self.uses_shared_zero = True
+            # hand the count to $ZERO in R13 and the return address in D
+            return_label = self.get_label("$zero")[1:]
+            self.write(f"@{num_locals}")
+            self.write("D=A")
+            self.write("@R13")
+            self.write("M=D")
+            self.write(f"@{return_label}")
+            self.write("D=A")
+            self.write("@$ZERO")
+            self.write("0;JMP")
+            self.write(f"({return_label})")
 
     def get_label(self, label, is_declare=False):
         label = f"{self.current_function}${label}"
@@ -347,11 +893,34 @@ class CodeWriter:
 
     def write_call(self, function, num_args):
         self.write(f"// call {function} {num_args}")
+        self.call_count += 1
         return_label = self.get_label(f"$return_{self.return_idx}")[1:]
         self.return_idx += 1
+        if self.shared_calls:
+            self.uses_shared_call = True
+            # hand the arg count to $CALL in R13, the function in R14 and the return-address in D
+            self.write(f"@{num_args}")
+            self.write("D=A")
+            self.write("@R13")
+            self.write("M=D")
+            self.write(f"@{function}")
+            self.write("D=A")
+            self.write("@R14")
+            self.write("M=D")
+            self.write(f"@{return_label}")
+            self.write("D=A")
+            self.write("@$CALL")
+            self.write("0;JMP")
+        else:
+            self.write(f"@{return_label}")
+            self.write("D=A")
+            self.write_frame_save(num_args, function)
+        # declare return label
+        self.write(f"({return_label})")
+
+    # with no num_args or function given, they're read from R13 and R14 instead
+    def write_frame_save(self, num_args=None, function=None):
         # push return-address
-        self.write(f"@{return_label}")
-        self.write("D=A")
         self.write_pushpop(push_straight_from_d=True)
         # push lcl, arg, this and that
         self.write_pushpop("push", "RAM", 1)
@@ -361,8 +930,12 @@ class CodeWriter:
         # reposition arg
         self.write("@SP")
         self.write("D=M")
-        self.write(f"@{num_args}")
-        self.write("D=D-A")
+        if num_args is None:
+            self.write("@R13")
+            self.write("D=D-M")
+        else:
+            self.write(f"@{num_args}")
+            self.write("D=D-A")
         self.write("@5")
         self.write("D=D-A")
         self.write("@ARG")
@@ -373,10 +946,78 @@ class CodeWriter:
         self.write("@LCL")
         self.write("M=D")
         # goto f
-        self.write(f"@{function}")
+        if function is None:
+            self.write("@R14")
+            self.write("A=M")
+        else:
+            self.write(f"@{function}")
         self.write("0;JMP")
-        # declare return label
-        self.write(f"({return_label})")
+
+    def write_shared_routines(self):
+        if self.uses_shared_call:
+            self.write("// shared call routine")
+            self.write("($CALL)")
+            self.write_frame_save()
+        if self.uses_shared_return:
+            self.write("// shared return routine")
+            self.write("($RETURN)")
+            self.write_frame_teardown()
+        if self.uses_shared_zero:
+            self.write("// shared local zeroing routine")
+            self.write("($ZERO)")
+            # keep the return address safe in R14, then push R13 zeros
+            self.write("@R14")
+            self.write("M=D")
+            self.write("($ZERO_LOOP)")
+            self.write("@SP")
+            self.write("AM=M+1")
+            self.write("A=A-1")
+            self.write("M=0")
+            self.write("@R13")
+            self.write("MD=M-1")
+            self.write("@$ZERO_LOOP")
+            self.write("D;JGT")
+            self.write("@R14")
+            self.write("A=M")
+            self.write("0;JMP")
+        for command in sorted(self.used_comparisons):
+            routine = f"${command.upper()}"
+            self.write(f"// shared {command} routine")
+            self.write(f"({routine})")
+            # keep the return address safe in R15
+            self.write("@R15")
+            self.write("M=D")
+            # pop y, then replace x with true, and overwrite that with false unless the comparison holds
+            self.write_pop_into_d()
+            self.write("A=A-1")
+            self.write("D=M-D")
+            self.write("M=-1")
+            self.write(f"@{routine}_TRUE")
+            self.write(f"D;{CodeWriter.comparison_jumps[command]}")
+            self.write("@SP")
+            self.write("A=M-1")
+            self.write("M=0")
+            self.write(f"({routine}_TRUE)")
+            self.write("@R15")
+            self.write("A=M")
+            self.write("0;JMP")
+
+    def call_report(self):
+        # compare the call and return code of this build under both strategies, from what a single one costs
+        print("call/return strategy   ROM (words)   cycles per call+return")
+        for shared_calls in (False, True):
+            scratch = CodeWriter(None, shared_calls=shared_calls, in_memory=True)
+            scratch.current_function = "report"
+            scratch.write_call("report", 0)
+            call_size = scratch.line_count
+            scratch.write_return()
+            return_size = scratch.line_count - call_size
+            scratch.write_shared_routines()
+            routines_size = scratch.line_count - call_size - return_size
+            rom = self.call_count * call_size + self.return_count * return_size + routines_size
+            # the call and return sites and shared routines are all straight-line code, so each word is one cycle
+            cycles = call_size + return_size + routines_size
+            print(f"{shared_calls and 'shared' or 'inline':<22} {rom:>11}   {cycles:>22}")
 
     def write_init(self, sys_init):
         self.write("//init Stack pointer to STACK[0] (RAM[256])")
@@ -388,31 +1029,120 @@ class CodeWriter:
             self.write_call("Sys.init", 0)
 
     def write(self, text):
+        if self.peephole is not None:
+            self.instructions.append(text)
+        else:
+            self.emit(text)
+
+    def emit(self, text):
         if text[:1] not in "(/":
-            self.out_stream.write(text + f" //{self.line_count}\n")
+            if self.line_numbers:
+                text = f"{text} //{self.line_count}"
             self.line_count += 1
-        else:
-            self.out_stream.write(text + "\n")
+        self.buffer.append(text)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def translate_file(self, filename):
+        with open(filename) as in_stream:
+            self.translate_commands(os.path.basename(filename)[:-3], Parser(in_stream, streaming=True))
+
+    # translate one file's worth of commands, wherever they came from
+    def translate_commands(self, name, commands: Iterable[Command]):
+        self.current_file = name
+        self.label_count = -1
+        for command in commands:
+            self.write_command(command)
+        self.release_comparison()
+        self.spill()
+        self.flush_instructions()
 
-    def do_compile(self, filenames):
+    def stats(self):
+        return {"rom_before": self.peephole and self.peephole.rom_before,
+                "rom_after": self.peephole and self.peephole.rom_after,
+                "call_count": self.call_count,
+                "return_count": self.return_count,
+                "uses_shared_call": self.uses_shared_call,
+                "uses_shared_return": self.uses_shared_return,
+                "used_comparisons": self.used_comparisons,
+                "uses_shared_zero": self.uses_shared_zero}
+
+    def merge_fragment(self, text, stats):
+        # fragments have already been through the peephole optimiser, so go straight to emit
+        for line in text.splitlines():
+            self.emit(line)
+        if self.peephole is not None:
+            self.peephole.rom_before += stats["rom_before"]
+            self.peephole.rom_after += stats["rom_after"]
+        self.call_count += stats["call_count"]
+        self.return_count += stats["return_count"]
+        self.uses_shared_call = self.uses_shared_call or stats["uses_shared_call"]
+        self.uses_shared_return = self.uses_shared_return or stats["uses_shared_return"]
+        self.used_comparisons |= stats["used_comparisons"]
+        self.uses_shared_zero = self.uses_shared_zero or stats["uses_shared_zero"]
+
+    # the whole-program passes asked for, in an order that lets shaking drop whatever inlining left uncalled
+    def run_passes(self, program: Dict[str, List[Command]], inline=0, tree_shake=False) -> Dict[str, List[Command]]:
+        if inline:
+            inliner = Inliner(inline)
+            program = inliner.inline(program)
+            inliner.report()
+        if tree_shake:
+            shaker = TreeShaker()
+            program = shaker.shake(program)
+            shaker.report(self.options)
+        return program
+
+    def do_compile(self, filenames, jobs=1, inline=0, tree_shake=False):
         sys_init = False
         for filename in filenames:
             if os.path.basename(filename)[:-3] == "Sys":
                 sys_init = True
                 break
         self.write_init(sys_init)
-        for filename in filenames:
-            print(f"Compiling {filename}")
-            self.current_file = os.path.basename(filename)[:-3]
-            with open(filename) as in_stream:
-                parser = Parser(in_stream)
-                while parser.has_more_commands():
-                    parser.advance()
-                    self.write_command(parser.currentCommand)
+        self.flush_instructions()
+        # whole-program passes need every file read in before any of them can be translated
+        program = None
+        if inline or tree_shake:
+            program = self.run_passes(read_program(filenames), inline, tree_shake)
+        if jobs > 1:
+            # translate the files in parallel, but stitch them back together in the order they were given
+            with ProcessPoolExecutor(jobs) as pool:
+                fragments = pool.map(translate_fragment, filenames, [self.options] * len(filenames),
+                                     [program and program[os.path.basename(filename)[:-3]] for filename in filenames])
+                for filename, (text, stats) in zip(filenames, fragments):
+                    print(f"Compiling {filename}")
+                    self.merge_fragment(text, stats)
+        else:
+            for filename in filenames:
+                print(f"Compiling {filename}")
+                if program is None:
+                    self.translate_file(filename)
+                else:
+                    name = os.path.basename(filename)[:-3]
+                    self.translate_commands(name, program[name])
             # self.write("@.END")
             # self.write("(.END)")
             # self.write("0;JMP")
+        self.write_shared_routines()
         self.close()
+        if self.peephole is not None:
+            before, after = self.peephole.rom_before, self.peephole.rom_after
+            print(f"ROM size: {before} -> {after} instructions ({100 * (before - after) / max(before, 1):.1f}% smaller)")
+        if self.shared_calls:
+            self.call_report()
+
+
+def translate_fragment(filename, options, commands=None):
+    # translate a single file in a worker process, returning its assembly and what the main writer needs to know
+    writer = CodeWriter(None, **options)
+    writer.out_stream = io.StringIO()
+    if commands is None:
+        writer.translate_file(filename)
+    else:
+        writer.translate_commands(os.path.basename(filename)[:-3], commands)
+    writer.flush()
+    return writer.out_stream.getvalue(), writer.stats()
 
 
 if __name__ == "__main__":
@@ -421,6 +1151,24 @@ if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="Compiles a .vm file or directory of .vm files",
                                          prog="vm_compiler.py")
     arg_parser.add_argument("vm", help="the vm file to assemble")
+    arg_parser.add_argument("--line-numbers", help="annotate each instruction with its ROM address (for debugging)",
+                            action="store_true")
+    arg_parser.add_argument("-O", "--optimize", help="run the peephole optimiser over the generated assembly",
+                            action="store_true")
+    arg_parser.add_argument("--shared-calls", help="jump to one shared copy of the call and return code, to save ROM",
+                            action="store_true")
+    arg_parser.add_argument("--shared-compare", help="jump to one shared routine per comparison, and fuse comparisons "
+                                                     "with the if-goto that follows them", action="store_true")
+    arg_parser.add_argument("--cache-top", help="keep the top of the stack in D between commands, only storing it to "
+                                                "RAM at labels, jumps, calls and returns", action="store_true")
+    arg_parser.add_argument("-j", "--jobs", help="translate the files of a directory in this many processes",
+                            type=int, default=1)
+    arg_parser.add_argument("--inline", help="inline calls to leaf functions of at most this many VM commands",
+                            type=int, default=0, metavar="N")
+    arg_parser.add_argument("--tree-shake", help="leave out every function that can't be called from Sys.init",
+                            action="store_true")
+    arg_parser.add_argument("--hack", help="also assemble the output into a .hack file, straight from memory",
+                            action="store_true")
     # arg_parser.add_argument("--write", help="write a file, if --no-write just echo output",
     #                         action=argparse.BooleanOptionalAction, default=True)
     # arg_parser.add_argument("--overwrite", help="Overwrite file if it exists",
@@ -439,7 +1187,21 @@ if __name__ == "__main__":
 
     # if not _args.write:
     #     _outfile = None
-    _writer = CodeWriter(_outfile, True)  # _args.overwrite)
-    _writer.do_compile(_filenames)
+    _writer = CodeWriter(_outfile, True, line_numbers=_args.line_numbers, optimize=_args.optimize,
+                         shared_calls=_args.shared_calls, shared_compare=_args.shared_compare,
+                         cache_top=_args.cache_top)  # _args.overwrite)
+    if _args.hack:
+        _writer.lines = []
+    _writer.do_compile(_filenames, _args.jobs, _args.inline, _args.tree_shake)
+    if _args.hack:
+        # only assembling needs the assembler from project06
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project06"))
+        from Assembler import Assembler, write_hack
+        try:
+            _words = Assembler().assemble(_writer.lines)
+        except ValueError as e:
+            sys.exit(f"Couldn't assemble {_outfile}: {e}")
+        with open(_outfile[:-4] + ".hack", "w") as _out_stream:
+            write_hack(_words, _out_stream)
 
 # 8.2.1 Program Flow Commands - page 187
@@ -15,11 +15,18 @@ identifier_pattern = re.compile("[A-Za-z0-9_]+")
 symbols_to_xml = {"<": "&lt;", ">": "&gt;", "\"": "&quot;", "&": "&amp;"}
 
 
+# token types are small ints, token_types has their names
+KEYWORD, SYMBOL, INT_CONST, STRING_CONST, IDENTIFIER = range(5)
+token_types = ("KEYWORD", "SYMBOL", "INT_CONST", "STRING_CONST", "IDENTIFIER")
+
+
 class ParseError(Exception):
     pass
 
 
 class Token:
+    __slots__ = ("type", "value")
+
     def __init__(self, text):
         self.type = None
         self.value: Union[str, int] = text
@@ -29,12 +36,12 @@ class Token:
         if text[0] in " \n\t":
             return
         if text[0] == "\"":
-            self.type = "STRING_CONST"
+            self.type = STRING_CONST
             self.value = text[1:-1]
         elif text in keywords:
-            self.type = "KEYWORD"
+            self.type = KEYWORD
         elif text in symbols:
-            self.type = "SYMBOL"
+            self.type = SYMBOL
         elif text[0] in digits:
             try:
                 self.value = int(text)
@@ -42,17 +49,19 @@ class Token:
                 raise ParseError(f"Invalid Int literal: {text}")
             if self.value > 32767:
                 raise ParseError(f"Invalid Int literal for base 16: {text}")
-            self.type = "INT_CONST"
+            self.type = INT_CONST
         else:
             if identifier_pattern.match(text) is None:
                 raise ParseError(f"Invalid identifier: {text}")
-            self.type = "IDENTIFIER"
+            self.type = IDENTIFIER
+            # the same names turn up over and over, so share the one copy of each
+            self.value = sys.intern(text)
 
     def __repr__(self):
-        return f"{self.type}: {self.value}"
+        return f"{token_types[self.type]}: {self.value}"
 
     def xml(self):
-        xml_type = self.type.lower()
+        xml_type = token_types[self.type].lower()
         if "_" in xml_type:
             if xml_type[:3] == "int":
                 xml_type = "integerConstant"
@@ -161,7 +170,7 @@ class CompilationEngine:
     def assert_token_is_type(self, token_type, error=None, do_write=True):
         if not self.token_is_type(token_type):
             if error is None:
-                error = f"Expected {token_type} got {self.token.type} "
+                error = f"Expected {token_types[token_type]} got {token_types[self.token.type]} "
             raise ParseError(error)
         if do_write:
             self.write_token()
@@ -194,7 +203,7 @@ class CompilationEngine:
         self.assert_token_is("class")
 
         # className
-        self.assert_token_is_type("IDENTIFIER", "Expected a class name")
+        self.assert_token_is_type(IDENTIFIER, "Expected a class name")
 
         # {
         self.assert_token_is("{")
@@ -215,7 +224,7 @@ class CompilationEngine:
 
     def compile_type(self, allow_void=False):
         # type
-        if self.token_is(("int", "char", "boolean")) or self.token_is_type("IDENTIFIER") \
+        if self.token_is(("int", "char", "boolean")) or self.token_is_type(IDENTIFIER) \
                 or allow_void and self.token_is("void"):
             self.write_token()
         else:
@@ -226,12 +235,12 @@ class CompilationEngine:
         self.compile_type()
 
         # varName
-        self.assert_token_is_type("IDENTIFIER")
+        self.assert_token_is_type(IDENTIFIER)
 
         # (, varName)*
         while self.token_is(","):
             self.write_token()
-            self.assert_token_is_type("IDENTIFIER")
+            self.assert_token_is_type(IDENTIFIER)
 
         # ;
         self.assert_token_is(";")
@@ -257,7 +266,7 @@ class CompilationEngine:
         self.compile_type(True)
 
         # subroutineName
-        self.assert_token_is_type("IDENTIFIER")
+        self.assert_token_is_type(IDENTIFIER)
 
         # ( parameterList )
         self.assert_token_is("(")
@@ -286,7 +295,7 @@ class CompilationEngine:
             self.compile_type()
 
             # varName
-            self.assert_token_is_type("IDENTIFIER")
+            self.assert_token_is_type(IDENTIFIER)
 
             # if , then read another parameter, if it's neither , nor ) that's a syntax error
             if self.token_is(","):
@@ -342,7 +351,7 @@ class CompilationEngine:
         # .subroutineName ?
         if self.token_is("."):
             self.write_token()
-            self.assert_token_is_type("IDENTIFIER")
+            self.assert_token_is_type(IDENTIFIER)
 
         # ( expressionList )
         self.assert_token_is("(")
@@ -366,7 +375,7 @@ class CompilationEngine:
         # let
         self.write_token()
         # varName
-        self.assert_token_is_type("IDENTIFIER")
+        self.assert_token_is_type(IDENTIFIER)
 
         # [expression] ?
         if self.token_is("["):
@@ -461,11 +470,11 @@ class CompilationEngine:
         self.begin("term")
 
         # integerConstant
-        if self.token_is_type("INT_CONST"):
+        if self.token_is_type(INT_CONST):
             self.write_token()
 
         # stringConstant
-        elif self.token_is_type("STRING_CONST"):
+        elif self.token_is_type(STRING_CONST):
             self.write_token()
 
         # keywordConstant
@@ -473,7 +482,7 @@ class CompilationEngine:
             self.write_token()
 
         # varName | varName[expression] | subroutineCall
-        elif self.token_is_type("IDENTIFIER"):
+        elif self.token_is_type(IDENTIFIER):
             # subroutineCall
             if self.peek_next_token() == ".":
                 self.compile_subroutine_call()
@@ -3,11 +3,17 @@ import re
 import sys
 import argparse
 import glob
+import hashlib
+import json
+import shutil
 import token
-from typing import IO, Union, Dict
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from typing import IO, Union, Dict, Optional, Iterator, Iterable, Tuple
 
-keywords = "class constructor function method field static var int char boolean " \
-           "void true false null this let do if else while return".split(" ")
+keywords = frozenset("class constructor function method field static var int char boolean "
+                     "void true false null this let do if else while return".split(" "))
 
 symbols = "{}()[].,;+-*&|<=>~/"
 ops_to_vm = {
@@ -24,6 +30,14 @@ word_breaks = symbols[:-1] + " \t\n"
 digits = "0123456789"
 identifier_pattern = re.compile("[A-Za-z0-9_]+")
 symbols_to_xml = {"<": "&lt;", ">": "&gt;", "\"": "&quot;", "&": "&amp;"}
+# one pattern for the whole tokenizer: each match skips any whitespace and comments, then captures a single token
+# the token group matches at every position, so the skipping never has to give back part of a comment, and the
+# trailing whitespace and comments at the end of the file match as an empty token
+# a lone " or /* is an unterminated string or comment
+token_pattern = re.compile(r"""
+    (?: [ \t\n]+ | //[^\n]* | /\*.*?\*/ )*
+    ( "[^"\n]*" | ["] | /\* | [{}()\[\].,;+\-*&|<=>~/] | [^ \t\n{}()\[\].,;+\-*&|<=>~/"]+ | \Z )
+""", re.VERBOSE | re.DOTALL)
 kinds_to_segments = {
     "VAR": "local",
     "FIELD": "this",
@@ -32,11 +46,18 @@ kinds_to_segments = {
 }
 
 
+# token types are small ints, token_types has their names
+KEYWORD, SYMBOL, INT_CONST, STRING_CONST, IDENTIFIER = range(5)
+token_types = ("KEYWORD", "SYMBOL", "INT_CONST", "STRING_CONST", "IDENTIFIER")
+
+
 class ParseError(Exception):
     pass
 
 
 class Token:
+    __slots__ = ("type", "value")
+
     def __init__(self, text):
         self.type = None
         self.value: Union[str, int] = text
@@ -46,12 +67,12 @@ class Token:
         if text[0] in " \n\t":
             return
         if text[0] == "\"":
-            self.type = "STRING_CONST"
+            self.type = STRING_CONST
             self.value = text[1:-1]
         elif text in keywords:
-            self.type = "KEYWORD"
+            self.type = KEYWORD
         elif text in symbols:
-            self.type = "SYMBOL"
+            self.type = SYMBOL
         elif text[0] in digits:
             try:
                 self.value = int(text)
@@ -59,17 +80,19 @@ class Token:
                 raise ParseError(f"Invalid Int literal: {text}")
             if self.value > 32767:
                 raise ParseError(f"Invalid Int literal for base 16: {text}")
-            self.type = "INT_CONST"
+            self.type = INT_CONST
         else:
             if identifier_pattern.match(text) is None:
                 raise ParseError(f"Invalid identifier: {text}")
-            self.type = "IDENTIFIER"
+            self.type = IDENTIFIER
+            # the same names turn up over and over, so share the one copy of each
+            self.value = sys.intern(text)
 
     def __repr__(self):
-        return f"{self.type}: {self.value}"
+        return f"{token_types[self.type]}: {self.value}"
 
     def xml(self):
-        xml_type = self.type.lower()
+        xml_type = token_types[self.type].lower()
         if "_" in xml_type:
             if xml_type[:3] == "int":
                 xml_type = "integerConstant"
@@ -82,7 +105,70 @@ class Token:
         return f"<{xml_type}> {xml_text} </{xml_type}>"
 
 
+class TokenCache(dict):
+    # tokens are never modified, so each distinct piece of text only needs turning into a Token once
+    def __missing__(self, text):
+        if text == "/*":
+            raise ParseError("Unterminated comment")
+        if text == "\"":
+            raise ValueError("Newline found within a StringConstant")
+        token = self[text] = Token(text)
+        return token
+
+
+# keywords and symbols are the same in every file, so every cache can start off with them already made
+fixed_tokens = {text: Token(text) for text in keywords | set(symbols)}
+
+
+def tokenize(data: str, streaming=False) -> Iterator[Token]:
+    if streaming:
+        # only hold on to one match at a time, rather than the text of every token in the file
+        texts = map(itemgetter(1), token_pattern.finditer(data))
+    else:
+        texts = token_pattern.findall(data)
+    # everything but the first sighting of each token's text stays in C
+    return map(TokenCache(fixed_tokens).__getitem__, filter(None, texts))
+
+
+class TokenStream:
+    # an iterator over tokens, holding on to no more than the single token of lookahead the compiler needs
+    def __init__(self, tokens: Iterable[Token]):
+        self.tokens = iter(tokens)
+        self.lookahead: Optional[Token] = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Token:
+        if self.lookahead is not None:
+            token, self.lookahead = self.lookahead, None
+            return token
+        return next(self.tokens)
+
+    def peek(self) -> Token:
+        if self.lookahead is None:
+            self.lookahead = next(self.tokens, None)
+            if self.lookahead is None:
+                raise ParseError("Unexpected end of file")
+        return self.lookahead
+
+
 class Analyser:
+    def __init__(self, in_file: IO[str], streaming=False):
+        # in streaming mode tokens are only made as they're iterated over, so self.tokens can only be read once
+        self.tokens = tokenize(in_file.read(), streaming)
+        if not streaming:
+            self.tokens = list(self.tokens)
+
+    def write_xml(self, out_stream: IO[str]):
+        out_stream.write("<tokens>\n")
+        for token in self.tokens:
+            out_stream.write(token.xml() + "\n")
+        out_stream.write("</tokens>\n")
+
+
+# the original character-at-a-time tokenizer, kept as a reference to check and benchmark tokenize() against
+class CharAnalyser(Analyser):
     def __init__(self, in_file: IO[str]):
         self.tokens = []
         data = in_file.read()
@@ -137,18 +223,71 @@ class Analyser:
         if token.type is not None:
             self.tokens.append(token)
 
-    def write_xml(self, out_stream: IO[str]):
-        out_stream.write("<tokens>\n")
-        for token in self.tokens:
-            out_stream.write(token.xml() + "\n")
-        out_stream.write("</tokens>\n")
+
+# keeps a value in the 16 bit two's complement range of the Hack computer
+def to_signed(value):
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# n if value is +/- 2^n, or 0, and None otherwise
+def power_of_two(value):
+    magnitude = abs(value)
+    if magnitude & (magnitude - 1):
+        return None
+    return magnitude.bit_length() - 1 if magnitude else 0
+
+
+# what an operator does to constants, as the Hack computer would work it out - or None if it's best left to run time
+def fold_constants(op, x, y=None):
+    if y is None:
+        return to_signed(-x if op == "-" else ~x)
+    if op in ("<", "=", ">"):
+        # the VM translator compares by subtracting, so do the same, overflow and all
+        difference = to_signed(x - y)
+        return -((difference < 0) if op == "<" else (difference == 0) if op == "=" else (difference > 0))
+    if op == "/":
+        # Math.divide rounds towards 0, and goes wrong for -32768 just as this would
+        if y == 0 or -0x8000 in (x, y):
+            return None
+        quotient = abs(x) // abs(y)
+        return -quotient if (x < 0) != (y < 0) else quotient
+    return to_signed({"+": x + y, "-": x - y, "*": x * y, "&": x & y, "|": x | y}[op])
+
+
+# the expression tree read_expression builds: a constant, the code for something that can only be worked out at run
+# time, or an operation on one or two more of them
+class Constant:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Code:
+    __slots__ = ("commands",)
+
+    def __init__(self, commands):
+        self.commands = commands
+
+
+class Operation:
+    __slots__ = ("op", "operands")
+
+    def __init__(self, op, *operands):
+        self.op = op
+        self.operands = operands
 
 
 class CompilationEngine:
-    def __init__(self, analyser, out_stream):
-        self.vm_writer = VMWriter(out_stream)
-        self.tokens = analyser.tokens
-        self.idx = -1
+    def __init__(self, analyser, out_stream, optimize=False, pool_strings=False):
+        self.vm_writer = VMWriter(out_stream, optimize)
+        self.optimize = optimize
+        # string literals can each be built the first time they're used and kept in a hidden static from then on
+        self.pool_strings = pool_strings
+        self.string_statics: Dict[str, int] = {}
+        self.pooled_count = 0
+        self.tokens = TokenStream(analyser.tokens)
         self.token = None
         self.indent_level = 0
         self.labels = []
@@ -164,15 +303,11 @@ class CompilationEngine:
 
     # peek at the next token without advancing
     def peek_next_token(self):
-        return self.tokens[self.idx + 1].value
+        return self.tokens.peek().value
 
     # advance to the next token and return it
     def next_token(self):
-        self.idx += 1
-        try:
-            self.token = self.tokens[self.idx]
-        except IndexError:
-            pass
+        self.token = next(self.tokens, self.token)
         return self.token
 
     def token_is(self, value):
@@ -199,14 +334,14 @@ class CompilationEngine:
     def assert_token_is_type(self, token_type, error=None):
         if not self.token_is_type(token_type):
             if error is None:
-                error = f"Expected {token_type} got {self.token.type} "
+                error = f"Expected {token_types[token_type]} got {token_types[self.token.type]} "
             raise ParseError(error)
         value = self.token.value
         self.next_token()
         return value
 
     def read_var(self):
-        name = self.assert_token_is_type("IDENTIFIER")
+        name = self.assert_token_is_type(IDENTIFIER)
         if self.is_define:
             self.symbol_table.define(name, self.type, self.kind)
             return None, None
@@ -225,7 +360,7 @@ class CompilationEngine:
         self.assert_token_is("class", "Expected a class definition")
 
         # className
-        self.class_name = self.assert_token_is_type("IDENTIFIER", "Expected a class name")
+        self.class_name = self.assert_token_is_type(IDENTIFIER, "Expected a class name")
 
         # {
         self.assert_token_is("{")
@@ -240,11 +375,12 @@ class CompilationEngine:
 
         # }
         self.assert_token_is("}")
+        self.vm_writer.flush()
 
     def compile_type(self, allow_void=False):
         # type
         self.class_or_sub = "class"
-        if self.token_is(("int", "char", "boolean")) or self.token_is_type("IDENTIFIER") \
+        if self.token_is(("int", "char", "boolean")) or self.token_is_type(IDENTIFIER) \
                 or allow_void and self.token_is("void"):
             self.type = self.token.value
             self.next_token()
@@ -291,7 +427,7 @@ class CompilationEngine:
         # subroutineName
         self.class_or_sub = "subroutine"
         self.func_name = name = self.token.value
-        self.assert_token_is_type("IDENTIFIER")
+        self.assert_token_is_type(IDENTIFIER)
 
         # ( parameterList )
         self.assert_token_is("(")
@@ -371,7 +507,8 @@ class CompilationEngine:
                     raise ParseError(f"expected , or ) got {self.token.value}")
         return count
 
-    def compile_subroutine_call(self):
+    # returns whether the call left a value on the stack, which it always does unless discard_result is set
+    def compile_subroutine_call(self, discard_result=False):
         # (className. | varName.) ?
         is_method = False
         if self.peek_next_token() == ".":
@@ -399,24 +536,34 @@ class CompilationEngine:
 
         # subroutineName
         self.class_or_sub = "subroutine"
-        routine_name = self.assert_token_is_type("IDENTIFIER")
+        routine_name = self.assert_token_is_type(IDENTIFIER)
 
         # ( expressionList )
         self.assert_token_is("(")
         arg_count = self.compile_expression_list()
         self.assert_token_is(")")
 
-        self.vm_writer.write_call(f"{class_name}.{routine_name}", arg_count + is_method)
+        name = f"{class_name}.{routine_name}"
+        intrinsic = self.optimize and not is_method and intrinsics.get(name)
+        if intrinsic and intrinsic[0] == arg_count:
+            for command in intrinsic[1]:
+                self.vm_writer.write(*command)
+            if intrinsic[2]:
+                return True
+            # stand in for the 0 a void function returns, if anything's going to look at it
+            if not discard_result:
+                self.vm_writer.write_push("constant", 0)
+            return not discard_result
+        self.vm_writer.write_call(name, arg_count + is_method)
+        return True
 
     def compile_do(self):
         # do
         self.next_token()
 
-        # subroutineCall
-        self.compile_subroutine_call()
-
-        # trash the returned value
-        self.vm_writer.write_pop("temp", 0)
+        # subroutineCall, trashing the returned value
+        if self.compile_subroutine_call(discard_result=True):
+            self.vm_writer.write_pop("temp", 0)
         # ;
         self.assert_token_is(";")
 
@@ -551,55 +698,81 @@ class CompilationEngine:
             self.vm_writer.write_label(false_label)
 
     def compile_expression(self):
-        # push the first term
-        self.compile_term()
+        self.write_expression(self.read_expression())
+
+    # an expression as a tree, with any constant parts already worked out if optimising
+    def read_expression(self):
+        # the first term
+        node = self.read_term()
 
         # (op term)*
         while self.token_is(("+", "-", "*", "/", "&", "|", "<", ">", "=")):
-            # push the second term, then perform op
             op = self.token.value
             self.next_token()
-            self.compile_term()
-            self.vm_writer.write_arithmetic(op)
+            node = self.fold(Operation(op, node, self.read_term()))
+        return node
 
-    def compile_term(self):
+    def read_term(self):
         value = self.token.value
 
+        # a string literal is only ever a string, whatever keyword or symbol its text might look like
+        if self.token_is_type(STRING_CONST):
+            return Code(self.capture(self.compile_term))
+
         # integerConstant
-        if self.token_is_type("INT_CONST"):
-            self.vm_writer.write_push("constant", value)
+        if self.token_is_type(INT_CONST):
             self.next_token()
+            return Constant(value)
 
-        # stringConstant
-        elif self.token_is_type("STRING_CONST"):
-            string = self.token.value
-            # create the string object of the right size
-            self.vm_writer.write_push("constant", len(string))
-            self.vm_writer.write_call("String.new", 1)
+        # true is -1, and false and null are 0
+        if self.token_is(("true", "false", "null")):
+            self.next_token()
+            return Constant(-1 if value == "true" else 0)
 
-            # write each character
-            for char in string:
-                self.vm_writer.write_push("constant", ord(char))
-                self.vm_writer.write_call("String.appendChar", 2)
+        # ( expression )
+        if self.token_is("("):
+            self.next_token()
+            node = self.read_expression()
+            self.assert_token_is(")")
+            return node
 
-            # and advance to the next token
+        # unaryOp term
+        if self.token_is(("~", "-")):
             self.next_token()
+            return self.fold(Operation(value, self.read_term()))
 
-        # keywordConstant
-        elif self.token_is(("true", "false", "null", "this")):
-            # for true, false and null push 0
-            if value != "this":
-                self.vm_writer.write_push("constant", 0)
-                # and for true negate it to get -1
-                if value == "true":
-                    self.vm_writer.write_arithmetic("~")
+        # anything else has to be worked out at run time, so just keep the code for it
+        return Code(self.capture(self.compile_term))
+
+    # the commands compile_part writes, caught rather than written
+    def capture(self, compile_part):
+        write = self.vm_writer.write
+        commands = []
+        self.vm_writer.write = lambda command, arg1=None, arg2=None: commands.append((command, arg1, arg2))
+        try:
+            compile_part()
+        finally:
+            self.vm_writer.write = write
+        return commands
+
+    def compile_term(self):
+        # stringConstant
+        if self.token_is_type(STRING_CONST):
+            if self.pool_strings:
+                self.write_pooled_string(self.token.value)
             else:
-                # for this push pointer[0]
-                self.vm_writer.write_push("pointer", 0)
+                self.write_string(self.token.value)
+
+            # and advance to the next token
+            self.next_token()
+
+        # this is pointer[0]
+        elif self.token_is("this"):
+            self.vm_writer.write_push("pointer", 0)
             self.next_token()
 
         # varName | varName[expression] | subroutineCall
-        elif self.token_is_type("IDENTIFIER"):
+        elif self.token_is_type(IDENTIFIER):
             # subroutineCall
             if self.peek_next_token() == ".":
                 self.compile_subroutine_call()
@@ -627,38 +800,376 @@ class CompilationEngine:
                     # the provided compiler does it this way around, so this lets us do a textcompare more easily
                     self.vm_writer.write_push(var.kind, var.idx)
 
-        # ( expression )
-        elif self.token_is("("):
-            self.next_token()
-            self.compile_expression()
-            self.assert_token_is(")")
-
-        # unaryOp term
         else:
-            # save the operator
-            op = self.assert_token_is(("~", "-"), f"invalid term {self.token.value}")
+            raise ParseError(f"invalid term {self.token.value}")
+
+    # build a new String object holding the literal
+    def write_string(self, string):
+        # create the string object of the right size
+        self.vm_writer.write_push("constant", len(string))
+        self.vm_writer.write_call("String.new", 1)
+
+        # write each character
+        for char in string:
+            self.vm_writer.write_push("constant", ord(char))
+            self.vm_writer.write_call("String.appendChar", 2)
+
+    # push the one copy of a string literal, building it into its static the first time round - statics start out 0,
+    # which no String can be
+    def write_pooled_string(self, string):
+        if string not in self.string_statics:
+            # declared after all the class's own statics, under a name no Jack identifier can have
+            name = f"$string{len(self.string_statics)}"
+            self.symbol_table.define(name, "String", "STATIC")
+            self.string_statics[string] = self.symbol_table.idx_of(name)
+        index = self.string_statics[string]
+        ready_label = f"STRING_READY{self.pooled_count}"
+        self.pooled_count += 1
+        self.vm_writer.write_push("static", index)
+        self.vm_writer.write_if(ready_label)
+        self.write_string(string)
+        self.vm_writer.write_pop("static", index)
+        self.vm_writer.write_label(ready_label)
+        self.vm_writer.write_push("static", index)
+
+    # work out whatever of an operation can be worked out at compile time, when optimising
+    def fold(self, node):
+        if not self.optimize:
+            return node
+        op, operands = node.op, node.operands
+        if all(isinstance(operand, Constant) for operand in operands):
+            value = fold_constants(op, *(operand.value for operand in operands))
+            if value is not None:
+                return Constant(value)
+        if len(operands) == 1:
+            # - - x and ~ ~ x are just x
+            operand = operands[0]
+            if isinstance(operand, Operation) and len(operand.operands) == 1 and operand.op == op:
+                return operand.operands[0]
+            return node
+        left, right = operands
+        # a constant has no side effects, so it can swap sides with the other operand to where the rules below look
+        if isinstance(left, Constant) and op in ("+", "*", "&", "|"):
+            left, right = right, left
+            node = Operation(op, left, right)
+        if not isinstance(right, Constant):
+            return node
+        value = right.value
+        if value == 0 and op in ("+", "-", "|") or value == 1 and op in ("*", "/") or value == -1 and op == "&":
+            return left
+        if op in ("+", "-") and isinstance(left, Operation) and left.op in ("+", "-") and \
+                isinstance(left.operands[-1], Constant) and len(left.operands) == 2:
+            # (x + a) + b is x + (a + b)
+            inner = left.operands[1].value if left.op == "+" else -left.operands[1].value
+            total = to_signed(inner + (value if op == "+" else -value))
+            return self.fold(Operation("+", left.operands[0], Constant(total)))
+        if op in ("+", "-") and -0x8000 < value < 0:
+            # and x + -a is x - a, without the negation of a
+            return Operation("-" if op == "+" else "+", left, Constant(-value))
+        return node
+
+    def write_expression(self, node):
+        if isinstance(node, Constant):
+            self.write_constant(node.value)
+        elif isinstance(node, Code):
+            for command in node.commands:
+                self.vm_writer.write(*command)
+        elif len(node.operands) == 1:
             # evaluate term and then apply op
-            self.compile_term()
-            if op == "-":
+            self.write_expression(node.operands[0])
+            if node.op == "-":
                 self.vm_writer.write("neg")
             else:
-                self.vm_writer.write_arithmetic(op)
+                self.vm_writer.write_arithmetic(node.op)
+        elif self.optimize and node.op == "*" and isinstance(node.operands[1], Constant) and \
+                power_of_two(node.operands[1].value) is not None:
+            self.write_shifted(*node.operands)
+        else:
+            # push both terms, then perform op
+            self.write_expression(node.operands[0])
+            self.write_expression(node.operands[1])
+            self.vm_writer.write_arithmetic(node.op)
+
+    def write_constant(self, value):
+        if value >= 0:
+            self.vm_writer.write_push("constant", value)
+        elif value == -1 or value == -0x8000:
+            # ~0 and ~32767, since push constant can't push either of their negations
+            self.vm_writer.write_push("constant", ~value)
+            self.vm_writer.write_arithmetic("~")
+        else:
+            self.vm_writer.write_push("constant", -value)
+            self.vm_writer.write("neg")
+
+    # x * 2^n as x doubled n times, rather than a call to Math.multiply - keeping x in temp 1 to add it to itself
+    def write_shifted(self, x, factor):
+        shift = power_of_two(factor.value)
+        self.write_expression(x)
+        if factor.value == 0:
+            # x still has to be evaluated for its side effects, even when the answer is always 0
+            self.vm_writer.write_pop("temp", 1)
+            self.vm_writer.write_push("constant", 0)
+            return
+        for i in range(shift):
+            if i == 0 and isinstance(x, Code) and len(x.commands) == 1 and x.commands[0][0] == "push":
+                # a single push can just be pushed again
+                self.vm_writer.write(*x.commands[0])
+            else:
+                self.vm_writer.write_pop("temp", 1)
+                self.vm_writer.write_push("temp", 1)
+                self.vm_writer.write_push("temp", 1)
+            self.vm_writer.write_arithmetic("+")
+        if factor.value < 0:
+            self.vm_writer.write("neg")
+
+
+# the text of a VM command, from the (command, arg1, arg2) a VMWriter hands out - ("push", "constant", 7), ("goto",
+# "WHILE_EXP0", None) or ("add", None, None)
+def vm_text(command, arg1=None, arg2=None):
+    if arg1 is None:
+        return command
+    if arg2 is None:
+        return f"{command} {arg1}"
+    return f"{command} {arg1} {arg2}"
+
+
+# what each VM operator does to two constants, for folding them at compile time
+constant_ops = {
+    "add": lambda x, y: x + y,
+    "sub": lambda x, y: x - y,
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+    "eq": lambda x, y: -(x == y),
+    "gt": lambda x, y: -(x > y),
+    "lt": lambda x, y: -(x < y),
+}
+# OS functions simple enough to write in place of calling them: their argument count, the VM code that does the same
+# with the arguments on the stack, and whether that leaves a value behind
+intrinsics = {
+    "Memory.peek": (1, (("pop", "pointer", 1), ("push", "that", 0)), True),
+    "Memory.poke": (2, (("pop", "temp", 0), ("pop", "pointer", 1), ("push", "temp", 0), ("pop", "that", 0)), False),
+}
+# segments that the array store sequence of compile_let writes to, so a push from any of them can't be moved past it -
+# every slot of that moves with pointer 1, whichever of them it is
+array_store_segments = ("temp", "pointer", "that")
+
+
+# optimises a class's VM commands, as the (command, arg1, arg2) parts a VMWriter hands out, one function at a time
+# since that's what labels are scoped to
+class VMOptimizer:
+    def __init__(self):
+        self.before = 0
+        self.after = 0
+
+    def optimize(self, commands):
+        self.before += len(commands)
+        functions = []
+        for command in commands:
+            if command[0] == "function" or not functions:
+                functions.append([])
+            functions[-1].append(command)
+        optimized = []
+        for function in functions:
+            function = self.rotate_loops(function)
+            # each pass can open up chances for the other, so keep going until neither finds anything
+            while True:
+                folded = self.remove_dead_code(self.fold(function))
+                if folded == function:
+                    break
+                function = folded
+            optimized += function
+        self.after += len(optimized)
+        return optimized
+
+    # compile_while tests its condition at the top of the loop, so every time round costs a not and a goto as well as
+    # the if-goto. Test it at the bottom instead, jumping into the test the first time:
+    #   label EXP, cond, not, if-goto END, body, goto EXP, label END
+    # becomes
+    #   goto EXP, label END, body, label EXP, cond, if-goto END
+    # reusing END as the label of the body, which nothing else refers to
+    @staticmethod
+    def rotate_loops(commands):
+        references = Counter(command[1] for command in commands if command[0] in ("goto", "if-goto"))
+        labels = {command[1]: index for index, command in enumerate(commands) if command[0] == "label"}
+        rotated = True
+        while rotated:
+            rotated = False
+            for i in range(len(commands) - 1):
+                if commands[i][0] != "not" or commands[i + 1][0] != "if-goto" or \
+                        not VMOptimizer.is_boolean(commands, i):
+                    continue
+                done_label = commands[i + 1][1]
+                end = labels.get(done_label, -1)
+                if end <= i or commands[end - 1][0] != "goto" or references[done_label] != 1:
+                    continue
+                eval_label = commands[end - 1][1]
+                start = labels.get(eval_label, len(commands))
+                if start > i or references[eval_label] != 1 or \
+                        any(command[0] in ("label", "goto", "if-goto") for command in commands[start + 1:i]):
+                    continue
+                commands = (commands[:start] + [("goto", eval_label, None), ("label", done_label, None)] +
+                            commands[i + 2:end - 1] + [("label", eval_label, None)] + commands[start + 1:i] +
+                            [("if-goto", done_label, None)] + commands[end + 1:])
+                labels = {command[1]: index for index, command in enumerate(commands) if command[0] == "label"}
+                rotated = True
+                break
+        return commands
+
+    # where the commands that work out the value on top of the stack after commands[:end] start, or None if that
+    # isn't all in one straight run of code
+    @staticmethod
+    def value_start(commands, end) -> Optional[int]:
+        needed = 1
+        for i in range(end - 1, -1, -1):
+            command = commands[i]
+            if command[0] == "push":
+                needed -= 1
+            elif command[0] == "pop":
+                needed += 1
+            elif command[0] in ("neg", "not"):
+                pass
+            elif command[0] in constant_ops:
+                needed += 1
+            elif command[0] == "call":
+                needed += command[2] - 1
+            else:
+                return None
+            if needed == 0:
+                return i
+        return None
+
+    # whether the value on top of the stack after commands[:end] is always 0 or -1. Jack lets a condition be any int,
+    # and for anything else, branching on its not isn't the opposite of branching on it
+    @staticmethod
+    def is_boolean(commands, end) -> bool:
+        if end == 0:
+            return False
+        last = commands[end - 1]
+        if last[0] in ("eq", "gt", "lt") or last == ("push", "constant", 0):
+            return True
+        if last[0] == "not":
+            return VMOptimizer.is_boolean(commands, end - 1)
+        if last[0] in ("and", "or"):
+            y_start = VMOptimizer.value_start(commands, end - 1)
+            return y_start is not None and VMOptimizer.is_boolean(commands, end - 1) and \
+                VMOptimizer.is_boolean(commands, y_start)
+        return False
+
+    # peephole rules over the end of the commands so far, after each command is added
+    def fold(self, commands):
+        folded = []
+        for command in commands:
+            folded.append(command)
+            while self.fold_tail(folded):
+                pass
+        return folded
+
+    @staticmethod
+    def fold_tail(commands):
+        last = commands[-1]
+        previous = commands[-2] if len(commands) > 1 else (None, None, None)
+        # not not and neg neg cancel out
+        if last[0] in ("not", "neg") and previous[0] == last[0]:
+            del commands[-2:]
+            return True
+        # anything plus, minus or or 0 is itself
+        if last[0] in ("add", "sub", "or") and previous == ("push", "constant", 0):
+            del commands[-2:]
+            return True
+        # pushing something only to pop it straight back
+        if last[0] == "pop" and previous[0] == "push" and previous[1:] == last[1:]:
+            del commands[-2:]
+            return True
+        # a branch on false never happens, and one on true always does
+        if last[0] == "if-goto" and previous == ("push", "constant", 0):
+            del commands[-2:]
+            return True
+        if last[0] == "if-goto" and previous[0] == "not" and commands[-3:-2] == [("push", "constant", 0)]:
+            commands[-3:] = [("goto", last[1], None)]
+            return True
+        # and a jump to the very next command is no jump at all
+        if last[0] == "label" and previous == ("goto", last[1], None):
+            del commands[-2]
+            return True
+        if len(commands) < 3:
+            return False
+        first = commands[-3]
+        # arithmetic on two constants, so long as the answer is still something push constant can push
+        if last[0] in constant_ops and first[:2] == previous[:2] == ("push", "constant"):
+            value = constant_ops[last[0]](first[2], previous[2])
+            if value == -1:
+                commands[-3:] = [("push", "constant", 0), ("not", None, None)]
+                return True
+            if 0 <= value <= 0x7FFF:
+                commands[-3:] = [("push", "constant", value)]
+                return True
+        if len(commands) < 4:
+            return False
+        # compile_if branches to the true block and then jumps to the false one - branch on the condition's opposite
+        # to the false block instead, when that just means dropping a not:
+        #   not, if-goto TRUE, goto FALSE, label TRUE -> if-goto FALSE, label TRUE
+        if commands[-4][0] == "not" and first[0] == "if-goto" and previous[0] == "goto" and \
+                last == ("label", first[1], None) and VMOptimizer.is_boolean(commands, len(commands) - 4):
+            commands[-4:] = [("if-goto", previous[1], None), last]
+            return True
+        if len(commands) < 5:
+            return False
+        # an array store of a single value needn't park it in temp 0 while it sets that up:
+        #   push x, pop temp 0, pop pointer 1, push temp 0, pop that 0 -> pop pointer 1, push x, pop that 0
+        value = commands[-5]
+        if commands[-4:] == [("pop", "temp", 0), ("pop", "pointer", 1), ("push", "temp", 0), ("pop", "that", 0)] \
+                and value[0] == "push" and value[1] not in array_store_segments:
+            commands[-5:] = [("pop", "pointer", 1), value, ("pop", "that", 0)]
+            return True
+        return False
+
+    # drop labels nothing jumps to, and anything after a goto or return that no label makes reachable
+    @staticmethod
+    def remove_dead_code(commands):
+        references = {command[1] for command in commands if command[0] in ("goto", "if-goto")}
+        live = []
+        reachable = True
+        for command in commands:
+            if command[0] == "label":
+                if command[1] not in references:
+                    continue
+                reachable = True
+            if reachable:
+                live.append(command)
+            if command[0] in ("goto", "return"):
+                reachable = False
+        return live
 
 
 class VMWriter:
-    def __init__(self, out_stream):
+    def __init__(self, out_stream, optimize=False):
         self.out_stream = out_stream
+        # anything that can take commands as they are gets them that way, rather than as text it has to parse again
+        self.emit = getattr(out_stream, "write_command", self.write_text)
+        # when optimising, the whole class is held back here until flush, then optimised in one go
+        self.optimizer = VMOptimizer() if optimize else None
+        self.commands = []
+        self.write = self.hold if optimize else self.emit
+
+    def hold(self, command, arg1=None, arg2=None):
+        self.commands.append((command, arg1, arg2))
+
+    def flush(self):
+        if self.optimizer is not None:
+            for command in self.optimizer.optimize(self.commands):
+                self.emit(*command)
+            self.commands.clear()
 
-    def write(self, string):
-        self.out_stream.write(f"{string}\n")
+    def write_text(self, command, arg1=None, arg2=None):
+        self.out_stream.write(f"{vm_text(command, arg1, arg2)}\n")
 
     def write_push(self, segment, index):
         segment = kinds_to_segments.get(segment, segment)
-        self.write(f"push {segment} {index}")
+        self.write("push", segment, index)
 
     def write_pop(self, segment, index):
         segment = kinds_to_segments.get(segment, segment)
-        self.write(f"pop {segment} {index}")
+        self.write("pop", segment, index)
 
     def write_arithmetic(self, command):
         if command in ops_to_vm:
@@ -671,19 +1182,19 @@ class VMWriter:
             self.write_call(func, 2)
 
     def write_label(self, label):
-        self.write(f"label {label}")
+        self.write("label", label)
 
     def write_goto(self, label):
-        self.write(f"goto {label}")
+        self.write("goto", label)
 
     def write_if(self, label):
-        self.write(f"if-goto {label}")
+        self.write("if-goto", label)
 
     def write_call(self, name, n_args):
-        self.write(f"call {name} {n_args}")
+        self.write("call", name, n_args)
 
     def write_function(self, name, n_locals):
-        self.write(f"function {name} {n_locals}")
+        self.write("function", name, n_locals)
 
     def write_return(self):
         self.write("return")
@@ -756,12 +1267,101 @@ class SymbolTable:
         return table[name].idx
 
 
+# a hash of the compiler itself, so that changing the compiler invalidates anything built by an older version
+def compiler_version():
+    with open(__file__, "rb") as compiler_source:
+        return hashlib.sha256(compiler_source.read()).hexdigest()
+
+
+class BuildCache:
+    # keeps a copy of every .vm file built, along with a manifest of the hash of the .jack source it was built from
+    def __init__(self, directory, options: Optional[dict] = None):
+        self.directory = os.path.join(directory, ".jackcache")
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self.compiler = compiler_version()
+        # the options that change the code generated, which have to match as well as the compiler
+        self.options = options or {}
+        self.files: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            # anything built by a different compiler, or with different options, has to be rebuilt
+            if manifest.get("compiler") == self.compiler and manifest.get("options", {}) == self.options:
+                self.files = manifest.get("files", {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def source_hash(filename):
+        with open(filename, "rb") as source:
+            return hashlib.sha256(source.read()).hexdigest()
+
+    def cached_vm(self, filename):
+        return os.path.join(self.directory, os.path.basename(filename)[:-5] + ".vm")
+
+    # if the file is unchanged since it was cached, restore its .vm output from the cache and return True
+    def fetch(self, filename, source_hash):
+        cached_vm = self.cached_vm(filename)
+        if self.files.get(os.path.basename(filename)) == source_hash and os.path.exists(cached_vm):
+            shutil.copyfile(cached_vm, filename[:-5] + ".vm")
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def store(self, filename, source_hash):
+        os.makedirs(self.directory, exist_ok=True)
+        shutil.copyfile(filename[:-5] + ".vm", self.cached_vm(filename))
+        self.files[os.path.basename(filename)] = source_hash
+
+    def forget(self, filename):
+        self.files.pop(os.path.basename(filename), None)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.manifest_path, "w") as manifest_file:
+            json.dump({"compiler": self.compiler, "options": self.options, "files": self.files}, manifest_file,
+                      indent=1, sort_keys=True)
+
+
+# compile a single .jack file into a .vm file alongside it, returning the error message if it couldn't be compiled,
+# and a line on what the optimiser did if it was run
+def compile_file(filename, optimize=False, pool_strings=False) -> Tuple[Optional[str], Optional[str]]:
+    outfile = filename[:-5] + ".vm"
+    try:
+        with open(filename) as in_stream:  # type: IO[str]
+            analyser = Analyser(in_stream, streaming=True)
+            with open(outfile, "w") as out_stream:
+                compiler = CompilationEngine(analyser, out_stream, optimize, pool_strings)
+                compiler.compile_class()
+    except (ParseError, ValueError) as e:
+        return f"{type(e).__name__}: {e}", None
+    optimizer = compiler.vm_writer.optimizer
+    if optimizer is None:
+        return None, None
+    before, after = optimizer.before, optimizer.after
+    return None, (f"{compiler.class_name}: {before} -> {after} VM commands "
+                  f"({100 * (before - after) / max(before, 1):.1f}% fewer)")
+
+
 if __name__ == "__main__":
     if sys.argv[0][0] == "C":
         sys.argv.append(".")
     arg_parser = argparse.ArgumentParser(description="Compiles a .jack file or directory of .jack files",
                                          prog="JackAnalyzer.py")
     arg_parser.add_argument("jack", help="the jack file or directory to compile")
+    arg_parser.add_argument("-j", "--jobs", help="compile the classes of a directory in this many processes",
+                            type=int, default=1)
+    arg_parser.add_argument("--no-cache", help="recompile every class, rather than reusing unchanged ones from the "
+                                               ".jackcache build cache", action="store_true")
+    arg_parser.add_argument("-O", "--optimize", help="fold constants, drop dead code and labels, rework branches "
+                                                     "and array stores, and write Memory.peek and Memory.poke in place "
+                                                     "in the VM code", action="store_true")
+    arg_parser.add_argument("--pool-strings", help="build each string literal once, the first time it's used, and "
+                                                   "reuse it after that (so nothing may change or dispose of one)",
+                            action="store_true")
     # arg_parser.add_argument("--write", help="write a file, if --no-write just echo output",
     #                         action=argparse.BooleanOptionalAction, default=True)
     # arg_parser.add_argument("--overwrite", help="Overwrite file if it exists",
@@ -775,14 +1375,46 @@ if __name__ == "__main__":
     else:
         assert (_filename[-5:] == ".jack"), "jack must be a directory or .jack file"
         _filenames = [_filename]
-    for _filename in _filenames:
-        _outfile = _filename[:-5] + ".vm"
-        with open(_filename) as in_stream:  # type: IO[str]
+    _cache = None
+    _hashes = {}
+    if not _args.no_cache:
+        _cache = BuildCache(os.path.dirname(_filenames[0]), {"optimize": _args.optimize,
+                                                               "pool_strings": _args.pool_strings})
+        _hashes = {_filename: BuildCache.source_hash(_filename) for _filename in _filenames}
+        # only the classes which have changed since they were last built need compiling
+        _filenames = [_filename for _filename in _filenames if not _cache.fetch(_filename, _hashes[_filename])]
+    _errors = {}
+    if _args.jobs > 1:
+        # every class compiles independently, so they can all go in parallel
+        with ProcessPoolExecutor(_args.jobs) as _pool:
+            _results = _pool.map(compile_file, _filenames, [_args.optimize] * len(_filenames),
+                                 [_args.pool_strings] * len(_filenames))
+            for _filename, (_error, _report) in zip(_filenames, _results):
+                print(f"Compiling {_filename}")
+                if _report is not None:
+                    print(_report)
+                if _error is not None:
+                    _errors[_filename] = _error
+    else:
+        for _filename in _filenames:
             print(f"Compiling {_filename}")
-            _analyser = Analyser(in_stream)
-            with open(_outfile, "w") as _out_stream:
-                _compiler = CompilationEngine(_analyser, _out_stream)
-                _compiler.compile_class()
+            _error, _report = compile_file(_filename, _args.optimize, _args.pool_strings)
+            if _report is not None:
+                print(_report)
+            if _error is not None:
+                _errors[_filename] = _error
+    if _cache is not None:
+        for _filename in _filenames:
+            if _filename in _errors:
+                _cache.forget(_filename)
+            else:
+                _cache.store(_filename, _hashes[_filename])
+        _cache.save()
+        print(f"Build cache: {_cache.hits} hits, {_cache.misses} misses")
+    for _filename, _error in _errors.items():
+        print(f"{_filename}: {_error}")
+    if _errors:
+        sys.exit(1)
 
 
 # page 261 compiler
\ No newline at end of file
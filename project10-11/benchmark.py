@@ -0,0 +1,174 @@
+import gc
+import os
+import io
+import sys
+import glob
+import time
+import argparse
+from unittest import mock
+
+from JackCompiler import Analyser, CharAnalyser, CompilationEngine, Token, token_pattern, token_types
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project08"))
+from VMTranslator import Command, CodeWriter, CommandType
+
+os_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project12")
+
+
+# the best of repeat runs over every source for each function, since that's the one least disturbed by anything else
+# going on. the functions take turns, so a slow patch on the machine hits them all rather than just one, and the
+# garbage collector is kept out of it, as timeit does
+def best_times(functions, sources, repeat):
+    best = [None] * len(functions)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for i, function in enumerate(functions):
+                start = time.perf_counter()
+                for source in sources:
+                    function(source)
+                elapsed = time.perf_counter() - start
+                if best[i] is None or elapsed < best[i]:
+                    best[i] = elapsed
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best
+
+
+def benchmark_tokenizer(sources, repeat):
+    # there's no point timing them if they don't agree
+    for source in sources:
+        expected = [(token.type, token.value) for token in CharAnalyser(io.StringIO(source)).tokens]
+        actual = [(token.type, token.value) for token in Analyser(io.StringIO(source)).tokens]
+        assert actual == expected, "Analyser and CharAnalyser produced different tokens"
+    token_count = sum(len(Analyser(io.StringIO(source)).tokens) for source in sources)
+    char_time, regex_time = best_times([lambda source: CharAnalyser(io.StringIO(source)),
+                                        lambda source: Analyser(io.StringIO(source))], sources, repeat)
+    print(f"{len(sources)} files, {sum(map(len, sources))} characters, {token_count} tokens")
+    print("tokenizer        time (ms)   tokens/s")
+    for name, elapsed in (("CharAnalyser", char_time), ("Analyser", regex_time)):
+        print(f"{name:<14} {elapsed * 1000:>11.2f} {token_count / elapsed:>10.0f}")
+    print(f"speedup: {char_time / regex_time:.1f}x")
+
+
+# a separate copy of a string, as every token and command used to have before values were interned
+def fresh(value):
+    return "".join(list(value)) if isinstance(value, str) else value
+
+
+# how tokens and commands were laid out before they had __slots__, to compare the footprint against
+class DictToken:
+    def __init__(self, token_type, value):
+        self.type = token_type
+        self.value = value
+
+
+class DictCommand:
+    def __init__(self, command):
+        self.line_idx = 0
+        self.type = command.type.name
+        self.text = " ".join(str(part) for part in (command.arg1, getattr(command, "arg2", ""))
+                             if part not in ("", -1))
+        self.arg1 = fresh(command.arg1)
+        self.arg2 = command.arg2
+
+
+# the bytes taken by a list of objects and everything they hold, counting anything they share only once
+def footprint(objects):
+    seen = set()
+    size = sys.getsizeof(objects)
+    pending = list(objects)
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if hasattr(item, "__dict__") and not isinstance(item, type):
+            size += sys.getsizeof(item.__dict__)
+            pending.extend(item.__dict__.values())
+        elif hasattr(item, "__slots__"):
+            pending.extend(getattr(item, slot) for slot in item.__slots__ if hasattr(item, slot))
+    return size, len(objects)
+
+
+def benchmark_memory(sources, _repeat):
+    vm_sources = []
+    for source in sources:
+        out_stream = io.StringIO()
+        CompilationEngine(Analyser(io.StringIO(source)), out_stream).compile_class()
+        vm_sources.append(out_stream.getvalue())
+    # a Token per token, as the tokenizer used to make them - Analyser shares one between every token with the same
+    # text, which would measure that sharing rather than the layout
+    tokens = [Token(text) for source in sources for text in filter(None, token_pattern.findall(source))]
+    commands = [command for source in vm_sources for line in source.splitlines()
+                for command in [Command(line)] if hasattr(command, "arg1")]
+    rows = [
+        ("dict Token", footprint([DictToken(token_types[token.type], fresh(token.value)) for token in tokens])),
+        ("slots Token", footprint(tokens)),
+        ("dict Command", footprint([DictCommand(command) for command in commands])),
+        ("slots Command", footprint(commands)),
+    ]
+    print(f"{len(sources)} files, {len(tokens)} tokens, {len(commands)} VM commands, one object each")
+    print("the dict layouts are stand-ins with the attributes the old classes had, not the old classes themselves")
+    print("layout              bytes   bytes/object")
+    for name, (size, count) in rows:
+        print(f"{name:<14} {size:>11} {size / count:>14.1f}")
+
+
+# the instructions one command translates to on its own, top_in_d saying whether the top of the stack starts in D
+def command_size(command, top_in_d=False, **options):
+    writer = CodeWriter(None, **options, in_memory=True)
+    writer.current_function = "benchmark"
+    writer.top_in_d = top_in_d
+    writer.write_command(command)
+    return writer.line_count
+
+
+def benchmark_addressing(sources, _repeat):
+    # how often each push and pop form turns up in the compiled sources, to weigh them by
+    counts = {}
+    for source in sources:
+        out_stream = io.StringIO()
+        CompilationEngine(Analyser(io.StringIO(source)), out_stream).compile_class()
+        for line in out_stream.getvalue().splitlines():
+            command = Command(line)
+            if command.type in (CommandType.C_PUSH, CommandType.C_POP):
+                form = (line.split()[0], command.arg1, min(command.arg2, CodeWriter.max_address_steps + 1))
+                counts[form] = counts.get(form, 0) + 1
+    totals = [0, 0, 0]
+    print("instructions per form, with cache_top's pops taking the value from D")
+    print("form                   count   generic   templated   cache_top")
+    for form in sorted(counts):
+        command = Command(" ".join(map(str, form)))
+        # addressing every slot the general way, as it was done before there were templates
+        with mock.patch.dict(CodeWriter.address_templates, clear=True):
+            generic = command_size(command)
+        sizes = (generic, command_size(command), command_size(command, form[0] == "pop", cache_top=True))
+        for i, size in enumerate(sizes):
+            totals[i] += size * counts[form]
+        name = f"{form[0]} {form[1]} {form[2]}{'+' if form[2] > CodeWriter.max_address_steps else ''}"
+        print(f"{name:<20} {counts[form]:>7} {sizes[0]:>9} {sizes[1]:>11} {sizes[2]:>11}")
+    print(f"{'total':<20} {sum(counts.values()):>7} {totals[0]:>9} {totals[1]:>11} {totals[2]:>11}")
+
+
+benchmarks = {"tokenizer": benchmark_tokenizer, "memory": benchmark_memory, "addressing": benchmark_addressing}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmarks parts of the Jack compiler on a directory of .jack files",
+                                         prog="benchmark.py")
+    arg_parser.add_argument("benchmark", help="what to benchmark", choices=sorted(benchmarks))
+    arg_parser.add_argument("jack", help="the directory of .jack files to use (the project12 OS by default)",
+                            nargs="?", default=os_directory)
+    arg_parser.add_argument("--repeat", help="how many times to repeat each timing", type=int, default=30)
+    _args = arg_parser.parse_args()
+    _sources = []
+    for _filename in sorted(glob.glob(os.path.join(_args.jack, "*.jack"))):
+        with open(_filename) as in_stream:
+            _sources.append(in_stream.read())
+    if not _sources:
+        sys.exit(f"no .jack files found in {_args.jack}")
+    benchmarks[_args.benchmark](_sources, _args.repeat)
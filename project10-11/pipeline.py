@@ -0,0 +1,117 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from typing import Dict, List, Optional
+
+from JackCompiler import Analyser, CompilationEngine, ParseError, vm_text
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project08"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project06"))
+from VMTranslator import Command, CodeWriter
+from Assembler import Assembler, write_hack, write_binary
+
+os_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project12")
+
+
+# stands in for the .vm file a CompilationEngine writes to, turning each command it's given straight into a
+# VMTranslator Command
+class CommandCollector:
+    def __init__(self, keep_text=False):
+        self.commands: List[Command] = []
+        # the text is only kept if the .vm file is actually wanted
+        self.text: Optional[List[str]] = [] if keep_text else None
+
+    def write_command(self, command, arg1=None, arg2=None):
+        if self.text is not None:
+            self.text.append(f"{vm_text(command, arg1, arg2)}\n")
+        self.commands.append(Command.from_parts(command, arg1, arg2))
+
+
+# the .jack files that make up a program by class name - the OS's, unless the program has its own version of a class
+def find_sources(jack, os_dir=None) -> Dict[str, str]:
+    filenames = glob.glob(os.path.join(jack, "*.jack")) if os.path.isdir(jack) else [jack]
+    if os_dir is not None:
+        filenames = glob.glob(os.path.join(os_dir, "*.jack")) + filenames
+    return {os.path.basename(filename)[:-5]: filename for filename in filenames}
+
+
+# compile every class and translate it straight from memory, returning the lines of assembly
+def build(sources: Dict[str, str], vm_directory=None, optimize_vm=False, inline=0, tree_shake=False,
+          pool_strings=False, **options) -> List[str]:
+    writer = CodeWriter(None, **options, in_memory=True)
+    writer.lines = []
+    writer.write_init("Sys" in sources)
+    writer.flush_instructions()
+    program = {}
+    for name, filename in sources.items():
+        collector = CommandCollector(keep_text=vm_directory is not None)
+        try:
+            with open(filename) as in_stream:
+                CompilationEngine(Analyser(in_stream, streaming=True), collector, optimize_vm,
+                                  pool_strings).compile_class()
+        except (ParseError, ValueError) as e:
+            raise type(e)(f"{filename}: {e}") from e
+        if vm_directory is not None:
+            with open(os.path.join(vm_directory, name + ".vm"), "w") as out_stream:
+                out_stream.write("".join(collector.text))
+        program[name] = collector.commands
+    program = writer.run_passes(program, inline, tree_shake)
+    for name, commands in program.items():
+        writer.translate_commands(name, commands)
+    writer.write_shared_routines()
+    writer.close()
+    return writer.lines
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Builds a .jack file or directory of .jack files into a .hack "
+                                                     "program, without writing the .vm or .asm files in between",
+                                         prog="pipeline.py")
+    arg_parser.add_argument("jack", help="the jack file or directory to build")
+    arg_parser.add_argument("--os", help="the directory of OS .jack files to build in (project12 by default)",
+                            default=os_directory)
+    arg_parser.add_argument("--no-os", help="only build the program's own classes", action="store_true")
+    arg_parser.add_argument("-o", "--output", help="the .hack file to write (named after the program by default)")
+    arg_parser.add_argument("--binary", help="write a packed binary ROM image instead of lines of bits",
+                            action="store_true")
+    arg_parser.add_argument("--asm", help="also write the assembly to this file")
+    arg_parser.add_argument("--vm", help="also write each class's .vm file into this directory")
+    arg_parser.add_argument("--optimize-vm", help="run JackCompiler's optimiser over the VM code",
+                            action="store_true")
+    arg_parser.add_argument("--pool-strings", help="build each string literal once, the first time it's used, and "
+                                                   "reuse it after that", action="store_true")
+    arg_parser.add_argument("--inline", help="inline calls to leaf functions of at most this many VM commands",
+                            type=int, default=0, metavar="N")
+    arg_parser.add_argument("--tree-shake", help="leave out every function that can't be called from Sys.init",
+                            action="store_true")
+    arg_parser.add_argument("-O", "--optimize", help="run the peephole optimiser over the generated assembly",
+                            action="store_true")
+    arg_parser.add_argument("--shared-calls", help="jump to one shared copy of the call and return code, to save ROM",
+                            action="store_true")
+    arg_parser.add_argument("--shared-compare", help="jump to one shared routine per comparison, and fuse comparisons "
+                                                     "with the if-goto that follows them", action="store_true")
+    arg_parser.add_argument("--cache-top", help="keep the top of the stack in D between commands, only storing it to "
+                                                "RAM at labels, jumps, calls and returns", action="store_true")
+    _args = arg_parser.parse_args()
+    _sources = find_sources(_args.jack, None if _args.no_os else _args.os)
+    if not _sources:
+        sys.exit(f"no .jack files found in {_args.jack}")
+    _program = os.path.abspath(_args.jack)
+    _outfile = _args.output or (os.path.join(_program, os.path.basename(_program)) if os.path.isdir(_program)
+                                else _program[:-5]) + (".bin" if _args.binary else ".hack")
+    _start = time.perf_counter()
+    try:
+        _lines = build(_sources, _args.vm, _args.optimize_vm, _args.inline, _args.tree_shake, _args.pool_strings,
+                       optimize=_args.optimize, shared_calls=_args.shared_calls, shared_compare=_args.shared_compare,
+                       cache_top=_args.cache_top)
+        _words = Assembler().assemble(_lines)
+    except (ParseError, ValueError) as e:
+        sys.exit(f"{type(e).__name__}: {e}")
+    if _args.asm:
+        with open(_args.asm, "w") as _out_stream:
+            _out_stream.write("".join(f"{_line}\n" for _line in _lines))
+    with open(_outfile, "wb" if _args.binary else "w") as _out_stream:
+        (write_binary if _args.binary else write_hack)(_words, _out_stream)
+    print(f"Built {len(_sources)} classes into {len(_words)} words of ROM in {time.perf_counter() - _start:.2f}s")